@@ -22,3 +22,26 @@ MONGO_URL = "mongodb://{}:{}@localhost:{}/meetings".format(MONGO_USER,MONGO_PW,M
 #DEBUG = False # Because it's unsafe to run outside localhost
 GOOGLE_LICENSE_KEY = "client_secret.json"
 
+### Sessions
+SESSION_STORE = "mongo"   # or "memory" for a single process
+SESSION_TTL = 24 * 60 * 60   # seconds an unused session is kept
+
+### Index page
+MEETINGS_PER_PAGE = 50
+MEETING_LIST_TTL = 30    # seconds a page of the meeting list is reused
+
+### Google calendar fetching
+FETCH_WORKERS = 8    # calendars fetched at once
+FETCH_TIMEOUT = 10   # seconds allowed for each calendar
+BUSY_SOURCE = "events"   # lists just the meeting window each time;
+                         # "freebusy" for busy intervals only, or
+                         # "cached" to sync each calendar's whole
+                         # history once and then only the changes
+EVENT_CACHE_TTL = 7 * 24 * 60 * 60   # seconds an unused calendar stays cached
+DISCOVERY_FILE = "calendar-v3-discovery.json"   # made by 'make discovery'
+HTTP_POOL_SIZE = 100     # users whose Google connections are kept open
+LOG_EVENTS = False       # debug log each event checked for conflicts
+CONFLICT_JOBS = True     # /conflicts returns a job id to poll
+CONFLICT_WORKERS = 4     # jobs run at once
+JOB_TTL = 60 * 60        # seconds a finished job's status is kept
+
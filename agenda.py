@@ -2,7 +2,116 @@
 """
 # Date handling
 import arrow # Replacement for datetime, based on moment.js
+from arrow.parser import ParserError
+import re
+import functools
 
+# Compact storage of epoch times
+from array import array
+# k-way merge of sorted agendas
+import heapq
+import collections
+# Keeping agendas sorted as they grow
+import bisect
+import datetime
+
+# Epoch arithmetic for whole days
+SECONDS_PER_DAY = 24 * 60 * 60
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+
+class TimeFormat:
+
+    """
+    A date/time format compiled once, for the fixed formats
+    agenda uses.  arrow.get(text, fmt) rebuilds its regular
+    expression on every call; this builds the same expression
+    once and converts the matched fields directly.  The result
+    is the same Arrow (in UTC) that arrow.get would give, or
+    the same ParserError.
+
+    Only numeric tokens are supported:
+        YYYY MM M DD D HH H hh h mm m ss s A a
+    """
+
+    _TOKEN_RE = re.compile('(YYYY|MM?|DD?|HH?|hh?|mm?|ss?|A|a)')
+    _TOKEN_PATTERNS = {
+        'YYYY': r'\d{4}',
+        'MM': r'\d{2}', 'M': r'\d{1,2}',
+        'DD': r'\d{2}', 'D': r'\d{1,2}',
+        'HH': r'\d{2}', 'H': r'\d{1,2}',
+        'hh': r'\d{2}', 'h': r'\d{1,2}',
+        'mm': r'\d{2}', 'm': r'\d{1,2}',
+        'ss': r'\d{2}', 's': r'\d{1,2}',
+        'A': '(am|pm|AM|PM)',
+        'a': '(am|pm)',
+    }
+    _TOKEN_FIELDS = {
+        'YYYY': 'year', 'MM': 'month', 'M': 'month',
+        'DD': 'day', 'D': 'day',
+        'HH': 'hour', 'H': 'hour', 'hh': 'hour', 'h': 'hour',
+        'mm': 'minute', 'm': 'minute', 'ss': 'second', 's': 'second',
+    }
+
+    def __init__(self, fmt, memo_size=0):
+        """Compile a format.
+
+        Arguments:
+            fmt: an arrow format string, e.g. 'MM/DD/YYYY h:mm A'
+            memo_size: if non-zero, remember the results for up to
+                this many distinct strings (busy lists repeat the
+                same times a lot).  Arrow objects are never changed
+                in place, so sharing them is safe.
+        """
+        self.fmt = fmt
+        self.tokens = self._TOKEN_RE.findall(fmt)
+        # Literal text is copied into the expression as is, like arrow does
+        self.pattern = self._TOKEN_RE.sub(
+            lambda m: '(?P<{}>{})'.format(m.group(0),
+                                          self._TOKEN_PATTERNS[m.group(0)]),
+            fmt)
+        self.regex = re.compile(self.pattern, flags=re.IGNORECASE)
+        if memo_size:
+            self.parse = functools.lru_cache(maxsize=memo_size)(self._parse)
+        else:
+            self.parse = self._parse
+
+    def _parse(self, text):
+        """Parse text in this format into an Arrow object (UTC).
+
+        Raises:
+            ParserError if text does not match the format
+            ValueError if the fields are out of range
+        """
+        match = self.regex.search(text)
+        if match is None:
+            raise ParserError('Failed to match \'{0}\' when parsing \'{1}\''
+                              .format(self.pattern, text))
+        fields = {'year': 1, 'month': 1, 'day': 1,
+                  'hour': 0, 'minute': 0, 'second': 0}
+        am_pm = None
+        for token in self.tokens:
+            value = match.group(token)
+            if token in ('A', 'a'):
+                if value in ('am', 'AM'):
+                    am_pm = 'am'
+                elif value in ('pm', 'PM'):
+                    am_pm = 'pm'
+            else:
+                fields[self._TOKEN_FIELDS[token]] = int(value)
+
+        if am_pm == 'pm' and fields['hour'] < 12:
+            fields['hour'] += 12
+        elif am_pm == 'am' and fields['hour'] == 12:
+            fields['hour'] = 0
+        return arrow.Arrow(fields['year'], fields['month'], fields['day'],
+                           fields['hour'], fields['minute'], fields['second'])
+
+
+# The formats of Appt.from_string and Appt.from_dict
+STRING_TIME = TimeFormat('MM-DD-YYYY h:mm A', memo_size=4096)
+DICT_TIME = TimeFormat('MM/DD/YYYY h:mm A', memo_size=4096)
 
 
 class Appt:
@@ -12,6 +121,9 @@ class Appt:
     date and time, and ending at a later time the same day.
     """
 
+    # Agendas can hold a great many appointments; skip the per-instance dict
+    __slots__ = ('begin', 'end', 'desc')
+
     def __init__(self, begin, end, desc):
         """Create an appointment on date
         from begin time to end time.
@@ -49,17 +161,19 @@ class Appt:
         time = fields[0].strip()
         desc = fields[1].strip()
         fields = time.split(" to ")
+        if len(fields) != 2:
+            raise ValueError("Appt literal requires ' to ' between begin and end")
         start = fields[0]
         finish = fields[1]
-        begin = arrow.get(start, 'MM-DD-YYYY h:mm A')
-        end = arrow.get(finish, 'MM-DD-YYYY h:mm A')
+        begin = STRING_TIME.parse(start)
+        end = STRING_TIME.parse(finish)
         result = Appt(begin, end, desc)
         return result
 
     @classmethod
     def from_dict(cls, dict):
-        begin = arrow.get(dict["start"], "MM/DD/YYYY h:mm A")
-        end = arrow.get(dict["end"], "MM/DD/YYYY h:mm A")
+        begin = DICT_TIME.parse(dict["start"])
+        end = DICT_TIME.parse(dict["end"])
         desc = dict["desc"]
         return Appt(begin, end, desc)
 
@@ -173,6 +287,380 @@ class Appt:
         endstr = self.end.strftime("MM/DD/YYYY h:mm A")
         return begstr + " to " + endstr + "| " + self.desc
 
+def _overlapping(mine, theirs):
+    """Find which spans of one list overlap which spans of another.
+
+    Arguments:
+        mine, theirs: sequences of (begin, end) pairs.  Begin and
+            end may be anything comparable (arrow objects, epoch ints).
+    Returns:
+        A list parallel to mine; entry i is the sorted list of indexes
+        into theirs of the spans with a non-zero overlap with mine[i].
+
+    Both sides are swept in order of begin time.  Each side keeps
+    the spans that have started; when a new span starts, everything
+    still running on the other side overlaps it.  Finished spans are
+    dropped as they are scanned, so the cost is O(n + m + k) after
+    sorting.
+    """
+    mine_order = sorted(range(len(mine)), key=lambda i: mine[i][0])
+    theirs_order = sorted(range(len(theirs)), key=lambda j: theirs[j][0])
+    found = [ [ ] for span in mine ]
+    active_mine = [ ]
+    active_theirs = [ ]
+    i = j = 0
+    while i < len(mine_order) or j < len(theirs_order):
+        if j == len(theirs_order) or (
+                i < len(mine_order) and
+                mine[mine_order[i]][0] <= theirs[theirs_order[j]][0]):
+            index = mine_order[i]
+            i += 1
+            begin = mine[index][0]
+            active_theirs = [ other for other in active_theirs
+                              if theirs[other][1] > begin ]
+            found[index].extend(active_theirs)
+            active_mine.append(index)
+        else:
+            other = theirs_order[j]
+            j += 1
+            begin = theirs[other][0]
+            active_mine = [ index for index in active_mine
+                            if mine[index][1] > begin ]
+            for index in active_mine:
+                found[index].append(other)
+            active_theirs.append(other)
+
+    # Callers expect overlaps in the order of the other list
+    for overlaps in found:
+        overlaps.sort()
+    return found
+
+
+def _gaps(spans, begin, end):
+    """Generate the (begin, end) gaps between spans within a period.
+
+    Arguments:
+        spans: iterable of (begin, end, ...) tuples in order of begin.
+            Spans may overlap one another.
+        begin, end: the period to look for gaps in.
+    """
+    cur_time = begin
+    for span in spans:
+        if span[1] <= begin:
+            continue
+        if end <= span[0]:
+            break
+        if cur_time < span[0]:
+            yield (cur_time, span[0])
+        cur_time = max(span[1], cur_time)
+
+    if cur_time < end:
+        yield (cur_time, end)
+
+
+def _difference(spans, holes):
+    """Generate the parts of spans that are not within any hole,
+    walking both once, O(n + m).
+
+    Arguments:
+        spans: iterable of (begin, end, ...) tuples in order of begin,
+            not overlapping one another.  Anything after begin and end
+            (a description, say) is kept on each part.
+        holes: iterable of (begin, end) pairs in order of begin.
+            Holes may overlap one another.
+    """
+    holes = iter(holes)
+    hole = next(holes, None)
+    for span in spans:
+        begin, end = span[0], span[1]
+        while hole is not None and begin < end:
+            if hole[1] <= begin:
+                hole = next(holes, None)
+                continue
+            if end <= hole[0]:
+                break
+            if begin < hole[0]:
+                yield (begin, hole[0]) + tuple(span[2:])
+            #a hole running past this span may cut the next one too
+            begin = max(begin, hole[1])
+        if begin < end:
+            yield (begin, end) + tuple(span[2:])
+
+
+def _local_epoch(day, time, tzinfo):
+    """Epoch seconds of a time on a day in the time zone tzinfo."""
+    local = datetime.datetime.combine(day, time).replace(tzinfo=tzinfo)
+    return int(local.timestamp())
+
+
+def _daily_gaps(streams, date_range, day_start, day_end, tzinfo=None):
+    """Generate the (begin, end) epoch gaps within a daily window.
+
+    Arguments:
+        streams: iterables of (begin, end) epoch pairs, each in order
+            of begin.
+        date_range: (first, last) datetime.date, both included.
+        day_start, day_end: datetime.time, the window on each day.
+        tzinfo: time zone the window is in; None for UTC.
+
+    Rather than complementing day by day, the hours outside the window
+    are treated as one more sorted stream of busy spans (one per
+    night, built with range arithmetic) and merged with the others,
+    so the whole range takes a single pass over the sorted data.
+    In a time zone other than UTC the nights are worked out day by
+    day instead, as they change length with daylight saving time.
+    """
+    first, last = date_range
+    opens = day_start.hour * 3600 + day_start.minute * 60 + day_start.second
+    closes = day_end.hour * 3600 + day_end.minute * 60 + day_end.second
+    if opens >= closes:
+        raise ValueError("Daily window must end after it begins {} {}"
+                         .format(day_start, day_end))
+    first_day = (first.toordinal() - EPOCH_ORDINAL) * SECONDS_PER_DAY
+    last_day = (last.toordinal() - EPOCH_ORDINAL) * SECONDS_PER_DAY
+    if last_day < first_day:
+        return
+
+    if tzinfo is None:
+        nights = zip(range(first_day + closes, last_day, SECONDS_PER_DAY),
+                     range(first_day + SECONDS_PER_DAY + opens,
+                           last_day + SECONDS_PER_DAY, SECONDS_PER_DAY))
+        begin, end = first_day + opens, last_day + closes
+    else:
+        days = [ datetime.date.fromordinal(ordinal)
+                 for ordinal in range(first.toordinal(), last.toordinal() + 1) ]
+        windows = [ (_local_epoch(day, day_start, tzinfo),
+                     _local_epoch(day, day_end, tzinfo)) for day in days ]
+        nights = zip([ close for open, close in windows[:-1] ],
+                     [ open for open, close in windows[1:] ])
+        begin, end = windows[0][0], windows[-1][1]
+    spans = heapq.merge(nights, *streams)
+    for gap in _gaps(spans, begin, end):
+        yield gap
+
+
+def _ranked_slots(spans, duration, preferences):
+    """Generate (rank, begin) for every candidate slot start within
+    spans; lower ranks are better.  See Agenda.find_slots for the
+    preferences.
+
+    Arguments:
+        spans: iterable of (begin, end) epoch pairs.
+        duration: length of a slot in seconds.
+        preferences: dict of preferences.
+    """
+    step = preferences.get("step", 15 * 60)
+    buffer = preferences.get("buffer", 0)
+    part = preferences.get("part")
+    tzinfo = preferences.get("tzinfo") or datetime.timezone.utc
+    open_edges = preferences.get("open_edges", ())
+    for begin, end in spans:
+        #an edge with nothing busy beyond it needs no buffer
+        after_busy = begin not in open_edges
+        before_busy = end not in open_edges
+        for start in range(begin, end - duration + 1, step):
+            #how far short of the buffer the slot is, at either side
+            short = 0
+            if after_busy:
+                short = max(short, buffer - (start - begin))
+            if before_busy:
+                short = max(short, buffer - (end - start - duration))
+            if part is None:
+                wrong_part = 0
+            else:
+                morning = datetime.datetime.fromtimestamp(start, tzinfo).hour < 12
+                wrong_part = 0 if morning == (part == "morning") else 1
+            yield ((wrong_part, short, start), start)
+
+
+def _coverage(spans_lists, windows):
+    """Generate (begin, end, free) pieces covering the windows, where
+    free is how many of the span lists have no span there.  Pieces
+    next to each other have different counts.
+
+    Arguments:
+        spans_lists: lists of (begin, end) pairs, one list per
+            person; spans in one list must not overlap (normalize).
+        windows: (begin, end) pairs in order, not overlapping.
+
+    All the begins and ends are sorted together, O(N log N), then
+    swept once along with the windows.
+    """
+    total = len(spans_lists)
+    #an end sorts before a begin at the same time
+    changes = sorted([ (begin, 1) for spans in spans_lists for begin, end in spans ] +
+                     [ (end, -1) for spans in spans_lists for begin, end in spans ])
+    busy = 0
+    i = 0
+    piece = None
+    for opening, close in windows:
+        while i < len(changes) and changes[i][0] <= opening:
+            busy += changes[i][1]
+            i += 1
+        cur = opening
+        while cur < close:
+            upto = close
+            if i < len(changes) and changes[i][0] < close:
+                upto = changes[i][0]
+            if cur < upto:
+                if piece is not None and piece[1] == cur and piece[2] == total - busy:
+                    piece = (piece[0], upto, piece[2])
+                else:
+                    if piece is not None:
+                        yield piece
+                    piece = (cur, upto, total - busy)
+                cur = upto
+            if upto < close:
+                busy += changes[i][1]
+                i += 1
+    if piece is not None:
+        yield piece
+
+
+def _attended_runs(coverage, q):
+    """Generate the lists of consecutive pieces of coverage with at
+    least q free, each list touching end to end.
+    """
+    run = [ ]
+    for piece in coverage:
+        if piece[2] >= q and (not run or run[-1][1] == piece[0]):
+            run.append(piece)
+            continue
+        if run:
+            yield run
+        run = [ piece ] if piece[2] >= q else [ ]
+    if run:
+        yield run
+
+
+def _run_slots(run, duration):
+    """Generate (start, fewest free) for the slots of a given length
+    within a run of pieces that begin or end where a piece does,
+    keeping the smallest count over each slot with a sliding
+    window minimum, so each run is O(pieces).
+    """
+    for aligned in (run, [ (-end, -begin, free) for begin, end, free in reversed(run) ]):
+        limit = aligned[-1][1]
+        window = collections.deque()
+        j = 0
+        for i, (begin, end, free) in enumerate(aligned):
+            if begin + duration > limit:
+                break
+            while j < len(aligned) and aligned[j][0] < begin + duration:
+                while window and aligned[window[-1]][2] >= aligned[j][2]:
+                    window.pop()
+                window.append(j)
+                j += 1
+            while window[0] < i:
+                window.popleft()
+            fewest = aligned[window[0]][2]
+            if aligned is run:
+                yield (begin, fewest)
+            else:
+                #mirrored: this slot ends where the piece does
+                yield (-begin - duration, fewest)
+
+
+def _boundaries(index, agenda):
+    """Generate (time, change, index, desc) for each begin and end
+    in a normalized agenda.  At equal times an end sorts before a
+    begin, so appointments that merely touch never overlap.
+    """
+    for appt in agenda:
+        yield (appt.begin, 1, index, appt.desc)
+        yield (appt.end, -1, index, appt.desc)
+
+
+def _in_order(appts):
+    """Pass through a stream of appointments, checking that
+    they arrive in order of begin time.
+
+    Raises:
+        ValueError on the first appointment out of order
+    """
+    last = None
+    for appt in appts:
+        if last is not None and appt.begin < last:
+            raise ValueError("Appointment stream out of order at " + str(appt))
+        last = appt.begin
+        yield appt
+
+
+def normalize_stream(appts):
+    """Generate the normalized form of a stream of appointments,
+    merging overlaps exactly as Agenda.normalize does but without
+    holding the stream in memory.
+
+    Arguments:
+        appts: iterable of Appt in order of begin time (for instance
+            Agenda.iter_file over a sorted export).
+    Raises:
+        ValueError if the stream is not in order
+    """
+    cur = None
+    for appt in _in_order(appts):
+        if cur is None:
+            cur = appt
+        elif appt > cur:
+            yield cur
+            cur = appt
+        else:
+            cur = cur.union(appt)
+    if cur is not None:
+        yield cur
+
+
+def complement_stream(appts, freeblock):
+    """Generate the complement of a stream of appointments within
+    freeblock, exactly as Agenda.complement does but without holding
+    the stream in memory.  The stream need not be normalized.
+
+    Arguments:
+        appts: iterable of Appt in order of begin time
+        freeblock: an Appt, the period to look for free time in
+    Raises:
+        ValueError if the stream is not in order
+    """
+    spans = ((appt.begin, appt.end) for appt in _in_order(appts))
+    for begin, end in _gaps(spans, freeblock.begin, freeblock.end):
+        yield Appt(begin, end, freeblock.desc)
+
+
+class ParseReport:
+    """Lines that could not be read while parsing an agenda.
+    Keeps the first few (line number, reason) pairs and a count of
+    the rest, so a bad multi-gigabyte export cannot exhaust memory.
+    """
+
+    def __init__(self, limit=100):
+        """An empty report keeping at most limit errors."""
+        self.limit = limit
+        self.errors = [ ]
+        self.count = 0
+
+    def add(self, lineno, reason):
+        """Record that line number lineno failed for reason."""
+        self.count += 1
+        if len(self.errors) < self.limit:
+            self.errors.append((lineno, reason))
+
+    def __len__(self):
+        """Number of failed lines, including any not kept."""
+        return self.count
+
+    def __iter__(self):
+        """The kept (line number, reason) pairs."""
+        return self.errors.__iter__()
+
+    def __str__(self):
+        """One line per kept error."""
+        rep = [ "Failed on line {}: {}".format(lineno, reason)
+                for lineno, reason in self.errors ]
+        if self.count > len(self.errors):
+            rep.append("... and {} more".format(self.count - len(self.errors)))
+        return "\n".join(rep)
+
+
 class Agenda:
     """An Agenda is essentially a list of appointments,
     with some agenda-specific methods.
@@ -183,28 +671,51 @@ class Agenda:
         self.appts = [ ]
 
     @classmethod
-    def from_file(cls, f):
+    def from_file(cls, f, report=None):
         """Factory: Read an agenda from a file.
 
         Arguments:
             f:  A file object (as returned by io.open) or
                an object that emulates a file (like stringio).
+            report: (optional) a ParseReport to collect lines that
+               could not be read.  Without one they are printed.
         returns:
             An Agenda object
         """
         agenda = cls()
-        for line in f:
+        errors = report if report is not None else ParseReport()
+        for appt in cls.iter_file(f, errors):
+            agenda.append(appt)
+        if report is None and len(errors) > 0:
+            print(errors)
+        return agenda
+
+    @classmethod
+    def iter_file(cls, f, report=None):
+        """Generator: Read appointments from a file lazily,
+        one line at a time, so arbitrarily large files can be
+        streamed (e.g. into normalize_stream or complement_stream)
+        without holding them in memory.
+
+        Arguments:
+            f:  A file object or an object that emulates a file.
+            report: (optional) a ParseReport; lines that cannot be
+               read are recorded there and skipped.
+        yields:
+            An Appt for each appointment line, in file order.
+        """
+        for lineno, line in enumerate(f, 1):
             line = line.strip()
             if line == "" or line.startswith("#"):
                 # Skip blank lines and comments
-                pass
-            else:
-                try:
-                    agenda.append(Appt.from_string(line))
-                except ValueError as err:
-                    print("Failed on line: ", line)
-                    print(err)
-        return agenda
+                continue
+            try:
+                appt = Appt.from_string(line)
+            except (ValueError, ParserError) as err:
+                if report is not None:
+                    report.add(lineno, str(err))
+                continue
+            yield appt
 
     @classmethod
     def from_dict(cls, dict):
@@ -214,6 +725,30 @@ class Agenda:
 
         return agenda
 
+    @classmethod
+    def from_epoch_pairs(cls, pairs, desc=""):
+        """
+        Builds an agenda from [begin, end] epoch second pairs, the
+        compact form meetings are stored in (see epoch_pairs)
+        :param pairs: iterable of [begin, end] pairs
+        :param desc: description given to every appointment
+        :return: the agenda
+        """
+        agenda = cls()
+        for begin, end in pairs:
+            agenda.append_epoch(begin, end, desc)
+
+        return agenda
+
+    def epoch_pairs(self):
+        """
+        Converts the agenda to a list of [begin, end] epoch second
+        pairs, which is much smaller than list_convert when stored
+        :return:
+            list: a list of two item lists
+        """
+        return [ [begin, end] for begin, end in self._spans() ]
+
     def list_convert(self):
         """
         Converts the agenda to a list that can be past around using json
@@ -232,6 +767,19 @@ class Agenda:
         """Add an Appt to the agenda."""
         self.appts.append(appt)
 
+    def append_epoch(self, begin, end, desc):
+        """Add an appointment given as UTC epoch seconds."""
+        self.append(Appt(arrow.get(begin), arrow.get(end), desc))
+
+    def _empty(self):
+        """A new, empty agenda of the same kind."""
+        return Agenda()
+
+    def _spans(self):
+        """The appointments as (begin, end) epoch pairs."""
+        return ((appt.begin.timestamp, appt.end.timestamp)
+                for appt in self.appts)
+
     def intersect(self,other,desc=""):
         """Return a new agenda containing appointments
         that are overlaps between appointments in this agenda
@@ -246,17 +794,269 @@ class Agenda:
            desc:  If provided, this string becomes the title of
                 all the appointments in the result.
         """
+        theirs = list(other)
+        found = _overlapping(
+            [ (appt.begin, appt.end) for appt in self.appts ],
+            [ (appt.begin, appt.end) for appt in theirs ])
+
+        default_desc = (desc == "")
+        result = Agenda()
+        for thisappt, overlaps in zip(self.appts, found):
+            if default_desc:
+                desc = thisappt.desc
+            for other_index in overlaps:
+                result.append(thisappt.intersect(theirs[other_index],desc))
+
+        return result
+
+    def difference(self, other):
+        """Return a new agenda of the times that are within
+        appointments of this agenda but not within any appointment
+        of the other agenda, e.g. the free times left once one more
+        person's busy times are taken out.
+
+        This agenda must be normalized (in order, no overlaps), as
+        a free list is.  Only the other agenda is sorted, so the
+        cost is O(n + m log m) rather than recomputing from scratch.
+        Descriptions are kept from this agenda.
+        """
+        spans = ((appt.begin.timestamp, appt.end.timestamp, appt.desc)
+                 for appt in self.appts)
+        result = self._empty()
+        for begin, end, desc in _difference(spans, sorted(other._spans())):
+            result.append_epoch(begin, end, desc)
+        return result
+
+    def intersect_naive(self,other,desc=""):
+        """Reference implementation of intersect.
+        Compares every appointment in this agenda with every
+        appointment in the other agenda, so it is O(n*m); kept
+        to check the sweep in intersect against.
+
+        Arguments and result are exactly as for intersect.
+        """
         default_desc = (desc == "")
         result = Agenda()
-        for thisappt in self.appts:
+        theirs = list(other)
+        for thisappt in self:
             if default_desc:
                 desc = thisappt.desc
-            for otherappt in other.appts:
+            for otherappt in theirs:
                 if thisappt.overlaps(otherappt):
                     result.append(thisappt.intersect(otherappt,desc))
 
         return result
 
+    @classmethod
+    def intersect_many(cls, agendas, desc=""):
+        """Return a new agenda of the times that are within an
+        appointment in every one of the agendas, in one pass.
+
+        Gives the same blocks of time as chaining pairwise intersect
+        over normalized agendas, without building the intermediate
+        agendas: the begins and ends of all agendas are combined by
+        a heap-based k-way merge, O(N log k) for N appointments in k
+        agendas once they are normalized.
+
+        Arguments:
+           agendas: a list of Agendas
+           desc:  If provided, this string becomes the title of
+                all the appointments in the result.  Otherwise
+                titles are taken from the first agenda.
+        """
+        result = Agenda()
+        if len(agendas) == 0:
+            return result
+
+        default_desc = (desc == "")
+        streams = [ _boundaries(index, agenda.normalized())
+                    for index, agenda in enumerate(agendas) ]
+        covered = 0
+        start = None
+        for time, change, index, appt_desc in heapq.merge(*streams):
+            if index == 0 and change == 1 and default_desc:
+                desc = appt_desc
+            if covered == len(agendas) and start < time:
+                result.append(Appt(start, time, desc))
+            covered += change
+            start = time
+
+        return result
+
+    @classmethod
+    def common_free(cls, agendas, freeblock):
+        """Produce the times within freeblock that are free in
+        every one of the agendas, in one pass.
+
+        Gives the same result as complementing the concatenation of
+        all the agendas, without building it: the appointments of all
+        agendas are combined by a heap-based k-way merge, O(N log k)
+        for N appointments in k agendas once they are sorted.
+
+        Args:
+           agendas: a list of Agendas of busy times
+           freeblock: Looking for time blocks in this period
+               that are not conflicting with appointments in
+               any of the agendas.
+        Returns:
+           A new agenda whose appointments take their description
+           from freeblock.desc.
+        """
+        streams = [ ((appt.begin, appt.end) for appt in agenda.normalized())
+                    for agenda in agendas ]
+        comp = Agenda()
+        for begin, end in _gaps(heapq.merge(*streams),
+                                freeblock.begin, freeblock.end):
+            comp.append(Appt(begin, end, freeblock.desc))
+        return comp
+
+    @classmethod
+    def common_free_daily(cls, agendas, date_range, day_start, day_end,
+                          desc="Free", tzinfo=None):
+        """Produce the times free in every one of the agendas
+        within a working window on each day of a date range.
+
+        Like common_free, but the hours outside the daily window
+        (overnight) are never counted as free.  Times are compared
+        as UTC epochs; the window is taken to be in UTC unless a
+        time zone is given.
+
+        Args:
+           agendas: a list of Agendas of busy times
+           date_range: (first, last) datetime.date, both included
+           day_start, day_end: datetime.time, the window on each day
+           desc: description of the resulting appointments
+           tzinfo: (optional) time zone of the window, e.g. the
+               user's local time zone
+        Raises:
+           ValueError if day_end is not after day_start
+        """
+        streams = [ agenda.normalized()._spans() for agenda in agendas ]
+        comp = Agenda()
+        for begin, end in _daily_gaps(streams, date_range,
+                                      day_start, day_end, tzinfo):
+            comp.append_epoch(begin, end, desc)
+        return comp
+
+    @classmethod
+    def attendance(cls, agendas, date_range, day_start, day_end, tzinfo=None):
+        """Count how many of the agendas are free, moment by moment,
+        within a working window on each day of a date range.  With
+        one agenda of busy times per invitee, this shows how many
+        could come at any time when no time suits everyone.
+
+        One sweep over all the busy times, O(N log N) for N busy
+        times in total however many agendas there are.
+
+        Args:
+           agendas: a list of Agendas of busy times, one per person
+           date_range: (first, last) datetime.date, both included
+           day_start, day_end: datetime.time, the window on each day
+           tzinfo: (optional) time zone of the window; UTC if None
+        Returns:
+           A list of (begin, end, free) covering the windows in
+           order, begin and end in epoch seconds and free the
+           number of agendas with nothing then; the count changes
+           from each piece to the next.
+        Raises:
+           ValueError if day_end is not after day_start
+        """
+        windows = _daily_gaps([ ], date_range, day_start, day_end, tzinfo)
+        return list(_coverage([ list(agenda.normalized()._spans()) for agenda in agendas ],
+                              windows))
+
+    @classmethod
+    def best_attended(cls, coverage, q, duration, k=5):
+        """The best k times for an appointment that at least q
+        people are free for the whole of, from attendance.
+
+        Slots are ranked by the fewest people free at any point in
+        them (most first), then earliest start.  Only slots that
+        begin or end where the count changes are considered; any
+        other slot is no better than one of those.
+
+        Args:
+           coverage: a list of (begin, end, free) from attendance
+           q: the fewest people who must be free
+           duration: length of the appointment, in seconds
+           k: how many slots to find
+        Returns:
+           A list of up to k (begin, end, free), best first.
+        Raises:
+           ValueError if duration is not positive
+        """
+        if duration <= 0:
+            raise ValueError("Slot length must be positive {}".format(duration))
+        fewest = { }
+        for run in _attended_runs(coverage, q):
+            for start, free in _run_slots(run, duration):
+                fewest[start] = free
+        best = heapq.nsmallest(k, ((-free, start) for start, free in fewest.items()))
+        return [ (start, start + duration, -free) for free, start in best ]
+
+    def complement_daily(self, date_range, day_start, day_end, desc="Free",
+                         tzinfo=None):
+        """Produce the complement of this agenda within a working
+        window on each day of a date range, for every day at once.
+        Same result as complementing each day's window separately,
+        in one pass over the normalized agenda.
+
+        Args:
+           date_range: (first, last) datetime.date, both included
+           day_start, day_end: datetime.time, the window on each day
+           desc: description of the resulting appointments
+           tzinfo: (optional) time zone of the window; UTC if None
+        Returns:
+           A new agenda of the same kind as this one.
+        Raises:
+           ValueError if day_end is not after day_start
+        """
+        comp = self._empty()
+        for begin, end in _daily_gaps([ self.normalized()._spans() ],
+                                      date_range, day_start, day_end, tzinfo):
+            comp.append_epoch(begin, end, desc)
+        return comp
+
+    def find_slots(self, duration, k, preferences=None, desc="Free"):
+        """Find the k best times to start an appointment of a given
+        length within the free time in this agenda.
+
+        Every step (15 minutes by default) from the beginning of
+        each free block is a candidate, as long as the appointment
+        still fits.  Candidates are ranked by, in order:
+           the part of the day, if one is preferred;
+           how far short they fall of the wanted buffer between the
+               appointment and the busy times either side of it;
+           earliest start.
+        A heap keeps just the best k, so the cost is linear in the
+        number of candidates (times log k).
+
+        Args:
+           duration: length of the appointment, in seconds
+           k: how many slots to find
+           preferences: (optional) dict of
+               "part": "morning" or "afternoon" (starting before or
+                   after noon);
+               "buffer": seconds of free time wanted on each side;
+               "open_edges": set of epoch times where free blocks
+                   end without running into busy time (the opening
+                   and closing of a daily window, say); no buffer is
+                   wanted there.  Any other end of a free block is
+                   taken to be busy time;
+               "step": seconds between candidate starts;
+               "tzinfo": time zone for "part"; UTC by default.
+           desc: description of the resulting appointments
+        Returns:
+           A new agenda of the same kind as this one, with up to k
+           appointments, best first.
+        """
+        spans = self.normalized()._spans()
+        best = heapq.nsmallest(k, _ranked_slots(spans, duration, preferences or { }))
+        slots = self._empty()
+        for rank, start in best:
+            slots.append_epoch(start, start + duration, desc)
+        return slots
+
     def normalize(self):
         """Merge overlapping events in an agenda. For example, if
         the first appointment is from 1pm to 3pm, and the second is
@@ -353,24 +1153,262 @@ class Agenda:
 
     def __str__(self):
         """String representation of a whole agenda"""
-        rep = ""
-        for appt in self.appts:
-            rep += str(appt) + "\n"
-        return rep[:-1]
+        return "\n".join(str(appt) for appt in self)
 
     def __eq__(self, other):
         """Equality, ignoring descriptions --- just equal blocks of time"""
-        if len(self.appts) != len(other.appts):
+        if len(self) != len(other):
             return False
-        for i in range(len(self.appts)):
-            mine = self.appts[i]
-            theirs = other.appts[i]
+        for mine, theirs in zip(self, other):
             if not (mine.begin == theirs.begin and
                     mine.end == theirs.end):
                 return False
         return True
 
 
+class ArrayAgenda(Agenda):
+    """An Agenda that keeps its appointments as parallel arrays:
+    begin and end times as int64 epoch seconds, descriptions in a
+    plain list.  A large agenda then costs a few machine words per
+    appointment rather than two arrow objects each, and normalize,
+    complement and intersect compare integers instead of arrows.
+    Appt objects are only built when something asks for them.
+    """
 
+    def __init__(self, tzinfo='UTC'):
+        """An empty agenda.
 
+        Arguments:
+            tzinfo: time zone of the arrow objects in Appt views
+        """
+        self.begins = array('q')
+        self.ends = array('q')
+        self.descs = [ ]
+        self.tzinfo = tzinfo
 
+    @classmethod
+    def from_agenda(cls, agenda):
+        """Factory: copy any Agenda into array storage."""
+        if isinstance(agenda, ArrayAgenda):
+            copy = cls(agenda.tzinfo)
+            copy.begins = array('q', agenda.begins)
+            copy.ends = array('q', agenda.ends)
+            copy.descs = list(agenda.descs)
+            return copy
+        appts = list(agenda)
+        copy = cls(appts[0].begin.tzinfo if appts else 'UTC')
+        for appt in appts:
+            copy.append(appt)
+        return copy
+
+    def appt(self, i):
+        """The i'th appointment as an Appt."""
+        return Appt(arrow.get(self.begins[i]).to(self.tzinfo),
+                    arrow.get(self.ends[i]).to(self.tzinfo),
+                    self.descs[i])
+
+    def append(self, appt):
+        """Add an Appt to the agenda."""
+        self.append_epoch(appt.begin.timestamp, appt.end.timestamp, appt.desc)
+
+    def append_epoch(self, begin, end, desc):
+        """Add an appointment given as epoch seconds.
+
+        Raises:
+            ValueError if appointment ends before it begins
+        """
+        if begin >= end:
+            raise ValueError("Appointment end must be after begin {} {}"
+                             .format(begin, end))
+        self.begins.append(begin)
+        self.ends.append(end)
+        self.descs.append(desc)
+
+    def _empty(self):
+        """A new, empty agenda in the same time zone."""
+        return ArrayAgenda(self.tzinfo)
+
+    def _spans(self):
+        """The appointments as (begin, end) epoch pairs."""
+        return zip(self.begins, self.ends)
+
+    def intersect(self, other, desc=""):
+        """Return a new ArrayAgenda containing the overlaps between
+        appointments in this agenda and appointments in the other.
+        Same results and description rules as Agenda.intersect.
+        """
+        if not isinstance(other, ArrayAgenda):
+            other = ArrayAgenda.from_agenda(other)
+        found = _overlapping(list(zip(self.begins, self.ends)),
+                             list(zip(other.begins, other.ends)))
+
+        default_desc = (desc == "")
+        result = self._empty()
+        for i, overlaps in enumerate(found):
+            if default_desc:
+                desc = self.descs[i]
+            for j in overlaps:
+                result.append_epoch(max(self.begins[i], other.begins[j]),
+                                    min(self.ends[i], other.ends[j]), desc)
+        return result
+
+    def difference(self, other):
+        """Return a new ArrayAgenda of the times in this (normalized)
+        agenda not within the other.  Same results as
+        Agenda.difference.
+        """
+        result = self._empty()
+        for begin, end, desc in _difference(
+                zip(self.begins, self.ends, self.descs),
+                sorted(other._spans())):
+            result.append_epoch(begin, end, desc)
+        return result
+
+    def normalize(self):
+        """Merge overlapping appointments, in place, exactly as
+        Agenda.normalize does.
+        """
+        if len(self.begins) == 0:
+            return
+
+        order = sorted(range(len(self.begins)), key=self.begins.__getitem__)
+        begins = array('q')
+        ends = array('q')
+        descs = [ ]
+        first = order[0]
+        cur_begin = self.begins[first]
+        cur_end = self.ends[first]
+        cur_desc = self.descs[first]
+        for i in order[1:]:
+            if cur_end <= self.begins[i]:
+                # Not overlapping
+                begins.append(cur_begin)
+                ends.append(cur_end)
+                descs.append(cur_desc)
+                cur_begin = self.begins[i]
+                cur_end = self.ends[i]
+                cur_desc = self.descs[i]
+            else:
+                # Overlapping
+                cur_end = max(cur_end, self.ends[i])
+                cur_desc = cur_desc + " " + self.descs[i]
+        begins.append(cur_begin)
+        ends.append(cur_end)
+        descs.append(cur_desc)
+        self.begins = begins
+        self.ends = ends
+        self.descs = descs
+
+    def normalized(self):
+        """A normalized copy of this agenda."""
+        copy = ArrayAgenda.from_agenda(self)
+        copy.normalize()
+        return copy
+
+    def complement(self, freeblock):
+        """Produce the free time within freeblock (an Appt), as a new
+        ArrayAgenda.  Same results as Agenda.complement.
+        """
+        copy = self.normalized()
+        comp = self._empty()
+        for begin, end in _gaps(zip(copy.begins, copy.ends),
+                                freeblock.begin.timestamp,
+                                freeblock.end.timestamp):
+            comp.append_epoch(begin, end, freeblock.desc)
+        return comp
+
+    def __len__(self):
+        """Number of appointments"""
+        return len(self.begins)
+
+    def __iter__(self):
+        """An iterator through Appt views of the appointments."""
+        return (self.appt(i) for i in range(len(self.begins)))
+
+    def __eq__(self, other):
+        """Equality, ignoring descriptions; two ArrayAgendas just
+        compare their arrays, without building any Appt.
+        """
+        if isinstance(other, ArrayAgenda):
+            return self.begins == other.begins and self.ends == other.ends
+        return Agenda.__eq__(self, other)
+
+
+class SortedAgenda(Agenda):
+    """An Agenda that keeps its appointments in order of begin time
+    as they are added, and keeps its normalized form up to date.
+
+    Each append finds its place by bisection and re-merges only the
+    blocks of the normalized form that the new appointment overlaps,
+    so asking for free time again after every append (one per invitee,
+    say) needs no sort.  An append is still O(n): it takes O(log n)
+    comparisons plus the local merge, but inserting into the lists
+    moves the entries after it (a memmove, cheap next to comparing
+    arrows).  normalized() copies the cached lists, also O(n);
+    complement only looks at the blocks near freeblock.
+    The normalized form, descriptions included, is always exactly what
+    Agenda.normalize would give.
+    """
+
+    def __init__(self):
+        """An empty agenda."""
+        self.appts = [ ]
+        self._begins = [ ]
+        self._merged = [ ]
+        self._merged_begins = [ ]
+
+    def append(self, appt):
+        """Add an Appt to the agenda, in order.  Appointments with
+        the same begin time stay in the order they were added.
+        """
+        i = bisect.bisect_right(self._begins, appt.begin)
+        self._begins.insert(i, appt.begin)
+        self.appts.insert(i, appt)
+
+        # Blocks of the normalized form that overlap the new appt
+        lo = bisect.bisect_right(self._merged_begins, appt.begin)
+        if lo > 0 and self._merged[lo - 1].end > appt.begin:
+            lo -= 1
+        hi = bisect.bisect_left(self._merged_begins, appt.end)
+
+        # Re-merge the appointments making up just those blocks
+        first = i
+        if lo < hi:
+            first = min(first, bisect.bisect_left(self._begins,
+                                                  self._merged_begins[lo]))
+        if hi < len(self._merged):
+            last = bisect.bisect_left(self._begins, self._merged_begins[hi])
+        else:
+            last = len(self.appts)
+        merged = list(normalize_stream(self.appts[first:last]))
+        self._merged[lo:hi] = merged
+        self._merged_begins[lo:hi] = [ block.begin for block in merged ]
+
+    def normalize(self):
+        """Replace the appointments by their (cached) normalized form."""
+        self.appts = list(self._merged)
+        self._begins = list(self._merged_begins)
+
+    def normalized(self):
+        """A normalized copy of this agenda, from the cache."""
+        copy = SortedAgenda()
+        copy.appts = list(self._merged)
+        copy._begins = list(self._merged_begins)
+        copy._merged = list(self._merged)
+        copy._merged_begins = list(self._merged_begins)
+        return copy
+
+    def complement(self, freeblock):
+        """Produce the complement of this agenda within freeblock,
+        exactly as Agenda.complement does.  Only the cached blocks
+        near freeblock are looked at.
+        """
+        start = max(bisect.bisect_right(self._merged_begins,
+                                        freeblock.begin) - 1, 0)
+        stop = bisect.bisect_left(self._merged_begins, freeblock.end)
+        spans = ((block.begin, block.end)
+                 for block in self._merged[start:stop])
+        comp = Agenda()
+        for begin, end in _gaps(spans, freeblock.begin, freeblock.end):
+            comp.append(Appt(begin, end, freeblock.desc))
+        return comp
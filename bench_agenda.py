@@ -0,0 +1,270 @@
+"""
+Benchmarks for agenda.py
+Run with:  python bench_agenda.py [--max N] [--density D] [--kind list|array]
+                                  [--out results.json] [--compare old.json]
+           python bench_agenda.py --parse N
+
+Times the Agenda operations (from_file, from_dict, normalize,
+intersect, complement, list_convert and __str__) on synthetic
+agendas of 10^2 appointments up to --max (10^6 by default), and
+measures the peak memory each one allocates with tracemalloc.
+The results are written as JSON to --out; give an earlier file
+to --compare to see how each number has changed.
+
+--parse times parsing a large synthetic busy list with arrow.get
+(what Appt.from_dict used to call) against the precompiled
+TimeFormat parser, with and without its memo cache.
+"""
+
+import io
+import json
+import time
+import random
+import argparse
+import datetime
+import platform
+import tracemalloc
+
+import arrow
+from agenda import Agenda, ArrayAgenda, Appt, TimeFormat, DICT_TIME
+
+## Agenda classes that can be benchmarked
+KINDS = { "list": Agenda, "array": ArrayAgenda }
+
+## Where synthetic agendas start: 03/01/2016 00:00 UTC
+BASE = 1456790400
+QUARTER_HOUR = 15 * 60
+
+
+def synthetic_busy(count, seed=399):
+    """
+    Make a list of busy event dicts like the ones main.py builds,
+    spread over about a month of quarter hours.
+    :param count: how many events
+    :return: list of {"start", "end", "desc"} dicts
+    """
+    rand = random.Random(seed)
+    base = arrow.get("2016-03-01T00:00:00")
+    events = []
+    for i in range(count):
+        begin = base.replace(minutes=+15 * rand.randint(0, 4 * 24 * 30))
+        end = begin.replace(minutes=+15 * rand.randint(1, 8))
+        events.append({
+            "start": begin.format("MM/DD/YYYY h:mm A"),
+            "end": end.format("MM/DD/YYYY h:mm A"),
+            "desc": "busy " + str(i)
+        })
+    return events
+
+
+def synthetic_spans(count, density=2.0, seed=399):
+    """
+    Make count appointments as (begin, end) epoch pairs on quarter
+    hours.  They last an hour on average and are spread so that
+    about density of them are going on at any time, so density 0.1
+    gives mostly separate appointments and density 10 a lot of
+    overlap.
+    :return: list of (begin, end) pairs in random order
+    """
+    rand = random.Random(seed)
+    quarters = max(1, int(count * 4 / density))
+    spans = []
+    for i in range(count):
+        begin = BASE + QUARTER_HOUR * rand.randint(0, quarters)
+        spans.append((begin, begin + QUARTER_HOUR * rand.randint(1, 7)))
+    return spans
+
+
+def _format(epoch, date_sep):
+    """An epoch time as MM/DD/YYYY h:mm A (with date_sep between
+    the parts of the date), without going through arrow.
+    """
+    when = datetime.datetime.utcfromtimestamp(epoch)
+    hour = when.hour % 12 or 12
+    return "{:02}{sep}{:02}{sep}{} {}:{:02} {}".format(
+        when.month, when.day, when.year, hour, when.minute,
+        "AM" if when.hour < 12 else "PM", sep=date_sep)
+
+
+class Case:
+    """The inputs for benchmarking one size of agenda."""
+
+    def __init__(self, count, density, kind):
+        spans = synthetic_spans(count, density)
+        self.count = count
+        self.kind = kind
+        self.agenda = kind()
+        for i, (begin, end) in enumerate(spans):
+            self.agenda.append(Appt(arrow.get(begin), arrow.get(end), "appt " + str(i)))
+        self.other = kind()
+        for begin, end in synthetic_spans(count, density, seed=400):
+            self.other.append(Appt(arrow.get(begin), arrow.get(end), "other"))
+        first = min(begin for begin, end in spans)
+        last = max(end for begin, end in spans)
+        self.freeblock = Appt(arrow.get(first), arrow.get(last), "Free")
+        #what Agenda.from_file and from_dict read
+        self.text = "\n".join("{} to {} | appt {}".format(
+            _format(begin, "-"), _format(end, "-"), i)
+            for i, (begin, end) in enumerate(spans))
+        self.dicts = [ { "start": _format(begin, "/"), "end": _format(end, "/"),
+                         "desc": "appt " + str(i) }
+                       for i, (begin, end) in enumerate(spans) ]
+
+    def copy(self):
+        """A fresh copy of the agenda, for operations that change it."""
+        fresh = self.kind()
+        for appt in self.agenda:
+            fresh.append(appt)
+        return fresh
+
+
+## Each operation takes a Case, does any setup that shouldn't be
+## measured, and returns the function to measure.
+OPERATIONS = [
+    ("from_file", lambda case: lambda: case.kind.from_file(io.StringIO(case.text))),
+    ("from_dict", lambda case: lambda: case.kind.from_dict(case.dicts)),
+    ("normalize", lambda case: case.copy().normalize),
+    ("intersect", lambda case: lambda: case.agenda.intersect(case.other)),
+    ("complement", lambda case: lambda: case.agenda.complement(case.freeblock)),
+    ("list_convert", lambda case: case.agenda.list_convert),
+    ("__str__", lambda case: case.agenda.__str__),
+]
+
+
+def measure(make, memory=True):
+    """
+    Time one run of an operation, then run it again under
+    tracemalloc for its peak memory (tracing slows it down too
+    much to do both at once).
+    :param make: returns the function to run, see OPERATIONS
+    :param memory: False to skip the memory run
+    :return: (seconds, peak bytes or None)
+    """
+    func = make()
+    started = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - started
+    peak = None
+    if memory:
+        func = make()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def bench_agenda(sizes, density=2.0, kind="list", memory=True):
+    """
+    Run every operation on agendas of each size
+    :return: list of {"op", "size", "seconds", "peak_bytes"} dicts
+    """
+    results = []
+    for size in sizes:
+        case = Case(size, density, KINDS[kind])
+        for name, make in OPERATIONS:
+            seconds, peak = measure(lambda: make(case), memory)
+            results.append({ "op": name, "size": size,
+                             "seconds": seconds, "peak_bytes": peak })
+            print("{:<14} {:>9} {:10.4f} s {:>14}".format(
+                name, size, seconds, "-" if peak is None else "{:,} B".format(peak)))
+    return results
+
+
+def compare(results, previous):
+    """Print each result against the same op and size in an earlier run."""
+    before = dict(((old["op"], old["size"]), old) for old in previous["results"])
+    print("{:<14} {:>9} {:>10} {:>10}".format("", "size", "time", "memory"))
+    for result in results:
+        old = before.get((result["op"], result["size"]))
+        if old is None:
+            continue
+        time_ratio = result["seconds"] / old["seconds"] if old["seconds"] else float("nan")
+        if result["peak_bytes"] and old["peak_bytes"]:
+            memory_ratio = "{:9.2f}x".format(result["peak_bytes"] / old["peak_bytes"])
+        else:
+            memory_ratio = "-"
+        print("{:<14} {:>9} {:9.2f}x {:>10}".format(
+            result["op"], result["size"], time_ratio, memory_ratio))
+
+
+def timed(label, func):
+    """Run func once, print and return how long it took."""
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print("{:<32} {:8.3f} s".format(label, elapsed))
+    return elapsed
+
+
+def bench_parse(count):
+    """Compare the ways of parsing count busy events."""
+    events = synthetic_busy(count)
+    print("Parsing {} busy events".format(count))
+
+    def with_arrow():
+        for event in events:
+            arrow.get(event["start"], "MM/DD/YYYY h:mm A")
+            arrow.get(event["end"], "MM/DD/YYYY h:mm A")
+
+    uncached = TimeFormat("MM/DD/YYYY h:mm A")
+
+    def with_format():
+        for event in events:
+            uncached.parse(event["start"])
+            uncached.parse(event["end"])
+
+    def with_memo():
+        DICT_TIME.parse.cache_clear()
+        for event in events:
+            DICT_TIME.parse(event["start"])
+            DICT_TIME.parse(event["end"])
+
+    slow = timed("arrow.get", with_arrow)
+    fast = timed("TimeFormat", with_format)
+    memo = timed("TimeFormat with memo", with_memo)
+    timed("Agenda.from_dict", lambda: Agenda.from_dict(events))
+    print("Speedup {:.1f}x, {:.1f}x with memo".format(slow / fast, slow / memo))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark agenda.py")
+    parser.add_argument("--max", type=int, default=10 ** 6,
+                        help="largest agenda; sizes go up by 10x from 100")
+    parser.add_argument("--density", type=float, default=2.0,
+                        help="average number of overlapping appointments")
+    parser.add_argument("--kind", choices=sorted(KINDS), default="list")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the tracemalloc runs")
+    parser.add_argument("--out", default="bench_agenda.json",
+                        help="file to write the results to")
+    parser.add_argument("--compare", help="results of an earlier run")
+    parser.add_argument("--parse", type=int, metavar="N",
+                        help="only compare parsers on N busy events")
+    args = parser.parse_args()
+
+    if args.parse:
+        bench_parse(args.parse)
+        return
+
+    sizes = []
+    size = 100
+    while size <= args.max:
+        sizes.append(size)
+        size *= 10
+    results = bench_agenda(sizes, args.density, args.kind, not args.no_memory)
+    with open(args.out, "w") as out:
+        json.dump({ "when": datetime.datetime.utcnow().isoformat(),
+                    "python": platform.python_version(),
+                    "arrow": arrow.__version__,
+                    "kind": args.kind,
+                    "density": args.density,
+                    "results": results }, out, indent=1)
+    print("Results written to " + args.out)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+
+
+if __name__ == "__main__":
+    main()
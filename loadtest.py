@@ -0,0 +1,345 @@
+"""
+Load test for main.py that runs without Google or a Mongo server.
+Run with:  python loadtest.py [--users 8] [--rounds 3] [--invitees 3]
+                              [--calendars 3] [--events 200] [--latency 0.05]
+                              [--record events.json] [--mongo memory|URL]
+                              [--out results.json]
+
+Each simulated user creates a meeting (/, /setrange, /choose,
+/conflicts until its job is done, /meeting/<id>), then that many
+invitees answer it (/invitee/<id>, /invitee_name, /choose,
+/conflicts).  Users run concurrently, each with its own session,
+against the app in this process.  Google is replaced by
+FakeCalendar, which makes up events (or plays back recorded ones
+from --record, a JSON object of calendar id -> list of events) a
+page at a time with a delay per call.  With --mongo memory (the
+default) the db is mongomock (in requirements-test.txt); otherwise
+give the URL of a scratch Mongo server.
+
+Prints p50/p99 latency per route and the overall throughput, which
+is what to go on when choosing the number of gunicorn workers.
+"""
+
+import sys
+import json
+import time
+import uuid
+import zlib
+import random
+import argparse
+import datetime
+import importlib.util
+import threading
+from contextlib import contextmanager
+
+import arrow
+
+
+class _Request:
+    """What the Google client's request objects look like to main.py"""
+
+    def __init__(self, latency, respond):
+        self.latency = latency
+        self.respond = respond
+
+    def execute(self):
+        time.sleep(self.latency)
+        return self.respond()
+
+
+class _Resource:
+    """A Google API resource: methods that give _Requests."""
+
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+
+class FakeCalendar:
+    """
+    Stands in for the Google Calendar service of every simulated
+    user.  Each user has calendars "<user>-0" (primary), "<user>-1"
+    and so on, each with events made up over the window asked for,
+    a page at a time, or the recorded events for that calendar id
+    if there are any.  Every call waits latency seconds.
+    """
+
+    def __init__(self, calendars=3, events=200, page_size=50, latency=0.05,
+                 recorded=None, seed=0):
+        self.calendars = calendars
+        self.events = events
+        self.page_size = page_size
+        self.latency = latency
+        self.recorded = recorded or { }
+        self.seed = seed
+
+    def service(self, user):
+        """The calendar service as user sees it."""
+        return _Resource(
+            calendarList=lambda: _Resource(
+                list=lambda **kw: _Request(self.latency, lambda: self.calendar_list(user))),
+            events=lambda: _Resource(
+                list=lambda **kw: _Request(self.latency, lambda: self.event_page(**kw))),
+            freebusy=lambda: _Resource(
+                query=lambda body: _Request(self.latency, lambda: self.freebusy(body))))
+
+    def calendar_list(self, user):
+        return { "items": [ { "kind": "calendar#calendarListEntry",
+                              "id": "{}-{}".format(user, i),
+                              "summary": "Calendar {}".format(i),
+                              "selected": True,
+                              "primary": i == 0 }
+                            for i in range(self.calendars) ] }
+
+    def calendar_events(self, cal, time_min=None, time_max=None):
+        """All the events of a calendar, made up over the window
+        (or the next week when syncing, which has no window).
+        """
+        if cal in self.recorded:
+            return self.recorded[cal]
+        first = arrow.get(time_min) if time_min else arrow.utcnow().floor('day')
+        last = arrow.get(time_max) if time_max else first.replace(days=+7)
+        quarters = max(1, int((last.timestamp - first.timestamp) / 900) - 8)
+        rand = random.Random(zlib.crc32(cal.encode()) + self.seed)
+        events = [ ]
+        for i in range(self.events):
+            begin = first.replace(minutes=+15 * rand.randint(0, quarters))
+            end = begin.replace(minutes=+15 * rand.randint(1, 8))
+            events.append({ "id": "{}-{}".format(cal, i),
+                            "summary": "Event {}".format(i),
+                            "start": { "dateTime": begin.isoformat() },
+                            "end": { "dateTime": end.isoformat() } })
+        events.sort(key=lambda event: event["start"]["dateTime"])
+        return events
+
+    def event_page(self, calendarId, pageToken=None, syncToken=None,
+                   timeMin=None, timeMax=None, **kw):
+        if syncToken is not None:
+            #nothing has changed since the last sync
+            return { "items": [ ], "nextSyncToken": syncToken }
+        events = self.calendar_events(calendarId, timeMin, timeMax)
+        start = int(pageToken or 0)
+        page = { "items": events[start:start + self.page_size] }
+        if start + self.page_size < len(events):
+            page["nextPageToken"] = str(start + self.page_size)
+        else:
+            page["nextSyncToken"] = "sync-" + calendarId
+        return page
+
+    def freebusy(self, body):
+        """Busy periods in UTC, as Google gives them when the query
+        has no timeZone (all-day events as if their calendar were
+        in UTC too).
+        """
+        calendars = { }
+        for item in body["items"]:
+            events = self.calendar_events(item["id"], body["timeMin"], body["timeMax"])
+            calendars[item["id"]] = { "busy": [ { "start": _utc(event["start"]),
+                                                  "end": _utc(event["end"]) }
+                                                for event in events
+                                                if event.get("transparency") != "transparent" ] }
+        return { "calendars": calendars }
+
+
+def _utc(time):
+    """An event's start or end as a UTC RFC 3339 time."""
+    when = arrow.get(time.get("dateTime") or time["date"]).to("UTC")
+    return when.format("YYYY-MM-DDTHH:mm:ss") + "Z"
+
+
+def load_app(fake, mongo):
+    """
+    Import main.py with Google replaced by fake and the db by
+    mongomock (mongo == "memory") or the Mongo server at URL mongo.
+    CONFIG.base.py is used if there is no CONFIG.py.
+    """
+    try:
+        import CONFIG
+    except ImportError:
+        spec = importlib.util.spec_from_file_location("CONFIG", "CONFIG.base.py")
+        CONFIG = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(CONFIG)
+        sys.modules["CONFIG"] = CONFIG
+    if mongo == "memory":
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    else:
+        CONFIG.MONGO_URL = mongo
+
+    import main
+    main.app.secret_key = str(uuid.uuid4())
+
+    @contextmanager
+    def fake_service(credentials, timeout=None):
+        yield fake.service(credentials.access_token)
+    main.get_gcal_service = fake_service
+    return main
+
+
+def credentials_for(user):
+    """OAuth2 credentials, as json, that main.py will take as valid
+    until tomorrow; the access token names the user for FakeCalendar.
+    """
+    from oauth2client import client
+    return client.OAuth2Credentials(
+        user, "loadtest", "secret", None,
+        datetime.datetime.utcnow() + datetime.timedelta(days=1),
+        "https://accounts.google.com/o/oauth2/token", "loadtest").to_json()
+
+
+class Recorder:
+    """Latencies of every request, by route, from all the users."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = { }
+        self.errors = { }
+
+    def add(self, route, seconds, ok=True):
+        with self.lock:
+            self.times.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def request(self, route, call, *args, **kwargs):
+        """Make a request with the test client call, timing it."""
+        started = time.perf_counter()
+        response = call(*args, **kwargs)
+        self.add(route, time.perf_counter() - started, response.status_code < 400)
+        return response
+
+
+def percentile(times, fraction):
+    """Nearest rank percentile of a sorted list."""
+    return times[max(0, int(round(fraction * len(times) + 0.5)) - 1)]
+
+
+def find_busy(main, client, recorder, cals, poll):
+    """GET /conflicts, then wait for its job, timing both."""
+    started = time.perf_counter()
+    reply = recorder.request("/conflicts", client.get, "/conflicts",
+                             query_string={ "cals": " ".join(cals) }).get_json()
+    status = "done" if "failed" in reply else "queued"
+    while status in ("queued", "running"):
+        time.sleep(poll)
+        status = recorder.request("/conflicts/<job>", client.get,
+                                  "/conflicts/" + reply["job"]).get_json()["status"]
+    recorder.add("/conflicts until done", time.perf_counter() - started,
+                 status == "done")
+
+
+def simulate_user(main, fake, recorder, number, args):
+    """One user creating args.rounds meetings, each answered by
+    args.invitees invitees.
+    """
+    dates = "{} - {}".format(arrow.now().replace(days=+1).format("MM/DD/YYYY"),
+                             arrow.now().replace(days=+5).format("MM/DD/YYYY"))
+    for round in range(args.rounds):
+        user = "user{}-{}".format(number, round)
+        title = "Load test meeting " + user
+        client = main.app.test_client()
+        recorder.request("/", client.get, "/")
+        recorder.request("/setrange", client.post, "/setrange",
+                         data={ "daterange": dates, "start": "9am", "end": "5pm",
+                                "about": title, "place": "Here" })
+        with client.session_transaction() as session:
+            session["credentials"] = credentials_for(user)
+        recorder.request("/choose", client.get, "/choose")
+        cals = [ "{}-{}".format(user, i) for i in range(fake.calendars) ]
+        find_busy(main, client, recorder, cals, args.poll)
+        meeting = main.collection.find_one({ "title": title }, { "_id": 1 })
+        if meeting is None:
+            recorder.add("/meeting/<id>", 0.0, False)
+            continue
+        id = str(meeting["_id"])
+        recorder.request("/meeting/<id>", client.get, "/meeting/" + id)
+
+        for invitee in range(args.invitees):
+            name = "{}-guest{}".format(user, invitee)
+            guest = main.app.test_client()
+            recorder.request("/invitee/<id>", guest.get, "/invitee/" + id)
+            recorder.request("/invitee_name", guest.post, "/invitee_name",
+                             data={ "name": name })
+            with guest.session_transaction() as session:
+                session["credentials"] = credentials_for(name)
+            recorder.request("/choose", guest.get, "/choose")
+            cals = [ "{}-{}".format(name, i) for i in range(fake.calendars) ]
+            find_busy(main, guest, recorder, cals, args.poll)
+
+
+def report(recorder, elapsed):
+    """Print the latencies per route and the throughput; return
+    them as a dict for --out.
+    """
+    routes = [ ]
+    print("{:<24} {:>7} {:>6} {:>9} {:>9} {:>9}".format(
+        "route", "count", "errors", "p50 ms", "p99 ms", "mean ms"))
+    for route in sorted(recorder.times):
+        times = sorted(recorder.times[route])
+        result = { "route": route, "count": len(times),
+                   "errors": recorder.errors.get(route, 0),
+                   "p50": percentile(times, 0.50), "p99": percentile(times, 0.99),
+                   "mean": sum(times) / len(times) }
+        routes.append(result)
+        print("{:<24} {:>7} {:>6} {:9.1f} {:9.1f} {:9.1f}".format(
+            route, result["count"], result["errors"], 1000 * result["p50"],
+            1000 * result["p99"], 1000 * result["mean"]))
+    #the "until done" times are made of requests already counted
+    requests = sum(result["count"] for result in routes
+                   if not result["route"].endswith("until done"))
+    print("{} requests in {:.2f} s: {:.1f} requests/s".format(
+        requests, elapsed, requests / elapsed))
+    return { "routes": routes, "requests": requests, "seconds": elapsed,
+             "throughput": requests / elapsed }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test main.py offline")
+    parser.add_argument("--users", type=int, default=8, help="concurrent users")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="meetings each user creates")
+    parser.add_argument("--invitees", type=int, default=3,
+                        help="invitees answering each meeting")
+    parser.add_argument("--calendars", type=int, default=3,
+                        help="calendars per user")
+    parser.add_argument("--events", type=int, default=200,
+                        help="events per calendar")
+    parser.add_argument("--page-size", type=int, default=50,
+                        help="events per page from the fake Google")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds each fake Google call takes")
+    parser.add_argument("--record", help="JSON of calendar id -> events to play back")
+    parser.add_argument("--poll", type=float, default=0.05,
+                        help="seconds between job status requests")
+    parser.add_argument("--mongo", default="memory",
+                        help="'memory' for mongomock, or a Mongo URL")
+    parser.add_argument("--out", help="file to write the results to as JSON")
+    args = parser.parse_args()
+
+    recorded = None
+    if args.record:
+        with open(args.record) as record:
+            recorded = json.load(record)
+    fake = FakeCalendar(args.calendars, args.events, args.page_size,
+                        args.latency, recorded)
+    app = load_app(fake, args.mongo)
+    recorder = Recorder()
+
+    users = [ threading.Thread(target=simulate_user,
+                               args=(app, fake, recorder, number, args))
+              for number in range(args.users) ]
+    started = time.perf_counter()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    results = report(recorder, time.perf_counter() - started)
+
+    if args.out:
+        results["args"] = vars(args)
+        with open(args.out, "w") as out:
+            json.dump(results, out, indent=1)
+
+
+if __name__ == "__main__":
+    main()
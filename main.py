@@ -5,12 +5,14 @@ Class: CIS 399
 """
 
 import flask
-from flask import render_template
 from flask import request
 from flask import url_for
 import uuid
 from agenda import Agenda
-from agenda import Appt
+from agenda import ArrayAgenda
+from agenda import EPOCH_ORDINAL, SECONDS_PER_DAY
+from session_store import StoredSessionInterface, MongoStore, MemoryStore
+import metrics
 import sys
 from flask import jsonify # For AJAX transactions
 from bson.objectid import ObjectId
@@ -21,6 +23,13 @@ from pymongo import MongoClient
 
 import json
 import logging
+import re
+import os
+import time
+import collections
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Date handling
 import arrow # Replacement for datetime, based on moment.js
@@ -33,6 +42,7 @@ import httplib2   # used in oauth2 flow
 
 # Google API for services
 from apiclient import discovery
+from apiclient.errors import HttpError
 
 ###
 # Globals
@@ -45,12 +55,98 @@ try:
     dbclient = MongoClient(CONFIG.MONGO_URL)
     db = dbclient.meetings
     collection = db.meet
+    #for listing meetings page by page
+    collection.create_index([("type", 1), ("_id", 1)])
+    #each participant's busy times, one document per meeting and
+    #participant (the organizer, or one invitee's answer) so a new
+    #invitee only writes their own
+    busy_collection = db.busy
+    busy_collection.create_index([("meeting", 1), ("invitee", 1)], unique=True)
+    #busy times and sync token per user calendar, see sync_calendar
+    #status of /conflicts jobs, see run_job
+    jobs = db.jobs
+    jobs.create_index("created", expireAfterSeconds=getattr(CONFIG, "JOB_TTL", 60 * 60))
+    event_cache = db.event_cache
+    event_cache.create_index([("user", 1), ("calendar", 1)], unique=True)
+    event_cache.create_index("synced",
+        expireAfterSeconds=getattr(CONFIG, "EVENT_CACHE_TTL", 7 * 24 * 60 * 60))
 
 except:
     print("Failure opening database.  Is Mongo running? Correct password?")
     sys.exit(1)
 
 
+## Sessions live on the server and the cookie holds only their id,
+## see session_store.py.  "memory" keeps them in this process only.
+SESSION_TTL = getattr(CONFIG, "SESSION_TTL", 24 * 60 * 60)
+if getattr(CONFIG, "SESSION_STORE", "mongo") == "memory":
+    app.session_interface = StoredSessionInterface(MemoryStore(SESSION_TTL))
+else:
+    app.session_interface = StoredSessionInterface(MongoStore(db.sessions, SESSION_TTL))
+
+## /conflicts runs on this many threads and returns a job id at
+## once, unless CONFLICT_JOBS is off
+CONFLICT_JOBS = getattr(CONFIG, "CONFLICT_JOBS", True)
+CONFLICT_WORKERS = getattr(CONFIG, "CONFLICT_WORKERS", 4)
+job_pool = ThreadPoolExecutor(max_workers=CONFLICT_WORKERS)
+
+## Times an invitee's answer re-reads the free list after another
+## answer changed it first
+FREE_UPDATE_TRIES = 5
+
+## Most slots /slots/<id> gives at once
+MAX_SLOTS = 50
+
+## Log every event checked against the meeting window (slow)
+LOG_EVENTS = getattr(CONFIG, "LOG_EVENTS", False)
+
+## Meetings listed on each index page, and how long a page is reused
+MEETINGS_PER_PAGE = getattr(CONFIG, "MEETINGS_PER_PAGE", 50)
+MEETING_LIST_TTL = getattr(CONFIG, "MEETING_LIST_TTL", 30)
+## Meetings removed per db round trip by /_delete
+DELETE_BATCH = 500
+
+## Workers for fetching several calendars at once
+FETCH_WORKERS = getattr(CONFIG, "FETCH_WORKERS", 8)
+FETCH_TIMEOUT = getattr(CONFIG, "FETCH_TIMEOUT", 10)
+fetch_pool = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+## Seconds between looks at fetches still queued for a worker
+FETCH_POLL = 0.1
+## When the fetch running in each fetch worker thread must stop
+fetch_deadline = threading.local()
+## Calendar API description; 'make discovery' saves a copy here
+DISCOVERY_FILE = getattr(CONFIG, "DISCOVERY_FILE", "calendar-v3-discovery.json")
+DISCOVERY_URI = "https://www.googleapis.com/discovery/v1/apis/calendar/v3/rest"
+## Users whose Google connections are kept open
+HTTP_POOL_SIZE = getattr(CONFIG, "HTTP_POOL_SIZE", 100)
+
+## Where busy times come from: "events", "freebusy" or "cached"
+## (see BUSY_SOURCES); a request can pick one with ?source=
+## Sync tokens can't be windowed, so "cached" lists a calendar's
+## whole history the first time; "events" only ever lists the window
+BUSY_SOURCE = getattr(CONFIG, "BUSY_SOURCE", "events")
+## Most calendars one freebusy query may ask about
+FREEBUSY_MAX_CALENDARS = 50
+## The parts of each event we use
+EVENT_FIELDS = "nextPageToken,items(start,end,summary,transparency)"
+SYNC_FIELDS = "nextPageToken,nextSyncToken,items(id,status,start,end,summary,transparency)"
+
+## Timings and counts shown on /metrics, see metrics.py
+REQUEST_SECONDS = metrics.Histogram("meetme_request_seconds",
+    "Time to answer a request", ["route"])
+REQUESTS = metrics.Counter("meetme_requests_total",
+    "Requests answered", ["route", "status"])
+GOOGLE_SECONDS = metrics.Histogram("meetme_google_seconds",
+    "Time in Google Calendar API calls", ["call"])
+MONGO_SECONDS = metrics.Histogram("meetme_mongo_seconds",
+    "Time in db operations", ["op"])
+AGENDA_SECONDS = metrics.Histogram("meetme_agenda_seconds",
+    "Time finding busy and free times", ["op"])
+RENDER_SECONDS = metrics.Histogram("meetme_render_seconds",
+    "Time rendering templates", ["template"])
+JOB_SECONDS = metrics.Histogram("meetme_job_seconds",
+    "Time to run a /conflicts job", ["status"])
+
 SCOPES = 'https://www.googleapis.com/auth/calendar.readonly'
 CLIENT_SECRET_FILE = CONFIG.GOOGLE_LICENSE_KEY
 APPLICATION_NAME = 'MeetMe class project'
@@ -61,13 +157,36 @@ APPLICATION_NAME = 'MeetMe class project'
 #
 #############################
 
+@app.before_request
+def start_timing():
+  flask.g.started = time.perf_counter()
+
+@app.after_request
+def record_timing(response):
+  route = request.url_rule.rule if request.url_rule is not None else "unknown"
+  REQUEST_SECONDS.labels(route=route).observe(time.perf_counter() - flask.g.started)
+  REQUESTS.labels(route=route, status=response.status_code).inc()
+  return response
+
+@app.route("/metrics")
+def show_metrics():
+  """The timings and counts, in the Prometheus text format."""
+  return flask.Response(metrics.REGISTRY.render(),
+                        content_type=metrics.CONTENT_TYPE)
+
+def render_template(template, **context):
+  """flask.render_template, timed"""
+  with RENDER_SECONDS.labels(template=template).time():
+    return flask.render_template(template, **context)
+
 @app.route("/")
 @app.route("/index")
 def index():
   app.logger.debug("Entering index")
-  if 'meetings' not in flask.session:
+  if 'begin_date' not in flask.session:
     init_session_values()
-  return render_template('index.html')
+  meetings, more = list_meetings(request.args.get('after'))
+  return render_template('index.html', meetings=meetings, more=more)
 
 @app.route("/choose")
 def choose():
@@ -81,9 +200,9 @@ def choose():
       app.logger.debug("Redirecting to authorization")
       return flask.redirect(flask.url_for('oauth2callback'))
 
-    gcal_service = get_gcal_service(credentials)
-    app.logger.debug("Returned from get_gcal_service")
-    flask.session['calendars'] = list_calendars(gcal_service)
+    with get_gcal_service(credentials) as gcal_service:
+        app.logger.debug("Returned from get_gcal_service")
+        flask.session['calendars'] = list_calendars(gcal_service)
     if flask.session['invitee'] == True:
         return render_template('invitee.html')
     else:
@@ -93,7 +212,7 @@ def choose():
 @app.route("/create")
 def create():
     app.logger.debug("Create")
-    return flask.render_template('create.html')
+    return render_template('create.html')
 
 ####
 #
@@ -116,7 +235,9 @@ def create():
 #  from the Google services. Service objects are NOT serializable ---
 #  we can't stash one in a cookie.  Instead, on each request we
 #  get a fresh serivce object from our credentials, which are
-#  serializable.
+#  serializable.  Building one is cheap: the API description is
+#  parsed once per process and the authorized connections are
+#  pooled per credential (see HttpPool).
 #
 #  Note that after authorization we always redirect to /choose;
 #  If this is unsatisfactory, we'll need a session variable to use
@@ -143,7 +264,70 @@ def valid_credentials():
     return credentials
 
 
-def get_gcal_service(credentials):
+class HttpPool:
+  """
+  Authorized httplib2.Http objects kept for reuse, so requests
+  from the same user go over connections that are already open
+  instead of a fresh Http each time.  Idle connections are kept
+  per credential (access token) and timeout; the credentials
+  used least recently are evicted once there are too many.
+  Safe to use from the fetch workers.
+  """
+
+  def __init__(self, max_credentials=100, per_credential=8):
+    self.max_credentials = max_credentials
+    self.per_credential = per_credential
+    self.idle = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def acquire(self, credentials, timeout=None):
+    """An authorized Http for credentials, reused if one is idle."""
+    key = (credentials.access_token, timeout)
+    with self.lock:
+      if self.idle.get(key):
+        self.idle.move_to_end(key)
+        return self.idle[key].pop()
+    return credentials.authorize(httplib2.Http(timeout=timeout))
+
+  def release(self, credentials, http, timeout=None):
+    """Give back an Http from acquire for someone else to use."""
+    key = (credentials.access_token, timeout)
+    with self.lock:
+      idle = self.idle.setdefault(key, [])
+      self.idle.move_to_end(key)
+      if len(idle) < self.per_credential:
+        idle.append(http)
+      while len(self.idle) > self.max_credentials:
+        self.idle.popitem(last=False)
+
+http_pool = HttpPool(max_credentials=HTTP_POOL_SIZE, per_credential=FETCH_WORKERS)
+
+## Parsed Google calendar API description, loaded once per process
+_calendar_api = None
+_calendar_api_lock = threading.Lock()
+
+def calendar_api():
+  """
+  The calendar v3 discovery document, parsed.  Read from the
+  DISCOVERY_FILE bundled with the app if there is one ('make
+  discovery' fetches it), otherwise fetched from Google the first
+  time it is needed.  Either way only once per process.
+  """
+  global _calendar_api
+  with _calendar_api_lock:
+    if _calendar_api is None:
+      if os.path.exists(DISCOVERY_FILE):
+        app.logger.debug("Loading discovery document from " + DISCOVERY_FILE)
+        with open(DISCOVERY_FILE) as f:
+          _calendar_api = json.load(f)
+      else:
+        app.logger.debug("Fetching discovery document")
+        response, content = httplib2.Http().request(DISCOVERY_URI)
+        _calendar_api = json.loads(content.decode('utf-8'))
+    return _calendar_api
+
+@contextmanager
+def get_gcal_service(credentials, timeout=None):
   """
   We need a Google calendar 'service' object to obtain
   list of calendars, busy times, etc.  This requires
@@ -152,12 +336,21 @@ def get_gcal_service(credentials):
   control flow will be interrupted by authorization, and we'll
   end up redirected back to /choose *without a service object*.
   Then the second call will succeed without additional authorization.
+  The optional timeout (seconds) applies to each request made
+  through the service.
+
+  Used as a context manager:
+      with get_gcal_service(credentials) as service: ...
+  so the service's connection goes back to http_pool afterwards.
   """
   app.logger.debug("Entering get_gcal_service")
-  http_auth = credentials.authorize(httplib2.Http())
-  service = discovery.build('calendar', 'v3', http=http_auth)
-  app.logger.debug("Returning service")
-  return service
+  http_auth = http_pool.acquire(credentials, timeout)
+  try:
+    service = discovery.build_from_document(calendar_api(), http=http_auth)
+    app.logger.debug("Returning service")
+    yield service
+  finally:
+    http_pool.release(credentials, http_auth, timeout)
 
 @app.route('/oauth2callback')
 def oauth2callback():
@@ -213,11 +406,21 @@ def oauth2callback():
 
 @app.route('/invitee_name', methods=['POST'])
 def invitee_name():
-    name = request.form.get('name')
+    name = request.form.get('name', '').strip()
     app.logger.debug(name)
+    if not name:
+        #the organizer's busy times are kept under the empty name
+        flask.flash("Please enter your name")
+        return flask.redirect(flask.url_for('invitee', id=flask.session['id']))
 
     flask.session['name']  = name
     flask.session['invitee'] = True
+    #busy times are kept per answer, not per name, so two invitees
+    #with the same name don't replace each other's; answering the
+    #same meeting again from this session replaces this answer
+    if flask.session.get('answer_meeting') != flask.session['id']:
+        flask.session['answer'] = uuid.uuid4().hex
+        flask.session['answer_meeting'] = flask.session['id']
     return flask.redirect(flask.url_for('choose'))
 
 
@@ -240,6 +443,15 @@ def setrange():
     app.logger.debug(start_time)
     app.logger.debug(end_time)
 
+    #the daily window can't run past midnight; check before keeping
+    #anything, so a meeting is never made with the window backwards
+    window_start = interpret_time(start_time)
+    window_end = interpret_time(end_time)
+    if arrow.get(window_end) <= arrow.get(window_start):
+        flask.flash("The end time {} must be after the start time {}"
+                    .format(end_time, start_time))
+        return flask.redirect(flask.url_for("create"))
+
     flask.session['invitee'] = False
     flask.session['title'] = about
     flask.session['place'] = location
@@ -249,8 +461,8 @@ def setrange():
     daterange_parts = daterange.split()
     flask.session['begin_date'] = interpret_date(daterange_parts[0])
     flask.session['end_date'] = interpret_date(daterange_parts[2])
-    flask.session['start_time'] = interpret_time(start_time)
-    flask.session['end_time'] = interpret_time(end_time)
+    flask.session['start_time'] = window_start
+    flask.session['end_time'] = window_end
     app.logger.debug("Setrange parsed {} - {}  dates as {} - {}".format(
       daterange_parts[0], daterange_parts[1],
       flask.session['begin_date'], flask.session['end_date']))
@@ -266,7 +478,6 @@ def init_session_values():
     """
     Start with some reasonable defaults for date and time ranges.
     Note this must be run in app context ... can't call from main.
-    Also load any meetings in the db so user can choose some
     """
     # Default date span = tomorrow to 1 week from now
     now = arrow.now('local')
@@ -281,15 +492,78 @@ def init_session_values():
     flask.session["begin_time"] = interpret_time("9am")
     flask.session["end_time"] = interpret_time("5pm")
 
-    #get a little meeting information so the user can see proposed meetings
-    meetings = []
-    for meeting in collection.find( { "type": "meeting" }):
-        meetings.append({
-            "type": meeting['type'],
-            "title": meeting['title'],
-            "id": str(meeting['_id'])
-        })
-    flask.session['meetings']=meetings
+####
+#
+#   Listing meetings for the index page
+#
+####
+
+## Recent pages of the meeting list: after -> (expires, (meetings, more))
+meeting_pages = {}
+## Most pages kept at once
+MEETING_PAGES_MAX = 100
+meeting_pages_lock = threading.Lock()
+
+def list_meetings(after=None):
+    """
+    Get a little meeting information so the user can see proposed
+    meetings: one page of titles and ids, oldest first.  Only the
+    title is read from the db, through the (type, _id) index, and
+    pages are kept for MEETING_LIST_TTL seconds so a burst of visits
+    doesn't hit the db each time.  Inserting or deleting a meeting
+    clears the pages (forget_meetings).
+    :param after: id of the last meeting on the previous page, if any;
+        anything that isn't a meeting id gives the first page
+    :return: (meetings, more) where meetings is a list of
+        {"title", "id"} dicts and more is the id to pass as after
+        for the next page, or None if this is the last page
+    """
+    #the key is our own spelling of the id, not whatever was sent
+    after = str(ObjectId(after)) if after and ObjectId.is_valid(after) else None
+    now = time.time()
+    with meeting_pages_lock:
+        cached = meeting_pages.get(after)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+    query = { "type": "meeting" }
+    if after:
+        query["_id"] = { "$gt": ObjectId(after) }
+    with MONGO_SECONDS.labels(op="list_meetings").time():
+        found = collection.find(query, { "title": 1 }).sort("_id", 1).limit(MEETINGS_PER_PAGE + 1)
+        meetings = [{ "title": meeting['title'], "id": str(meeting['_id']) }
+                    for meeting in found]
+    more = None
+    if len(meetings) > MEETINGS_PER_PAGE:
+        meetings = meetings[:MEETINGS_PER_PAGE]
+        more = meetings[-1]['id']
+
+    with meeting_pages_lock:
+        for stale in [key for key, (expires, page) in meeting_pages.items()
+                      if expires <= now]:
+            del meeting_pages[stale]
+        if len(meeting_pages) >= MEETING_PAGES_MAX:
+            #make room by dropping the page that would expire first
+            del meeting_pages[min(meeting_pages, key=lambda key: meeting_pages[key][0])]
+        meeting_pages[after] = (now + MEETING_LIST_TTL, (meetings, more))
+    return meetings, more
+
+def forget_meetings(ids=None):
+    """
+    The meeting list changed; drop the cached pages, or if we
+    know which meetings were deleted, just take those off the
+    cached pages.
+    (Other server processes see the change within MEETING_LIST_TTL.)
+    :param ids: ids (strings) of deleted meetings, or None
+    """
+    with meeting_pages_lock:
+        if ids is None:
+            meeting_pages.clear()
+            return
+        gone = set(ids)
+        for after, (expires, (meetings, more)) in list(meeting_pages.items()):
+            kept = [meeting for meeting in meetings if meeting['id'] not in gone]
+            meeting_pages[after] = (expires, (kept, more))
 
 def interpret_time( text ):
     """
@@ -346,7 +620,8 @@ def list_calendars(service):
     Google Calendars web app) calendars before unselected calendars.
     """
     app.logger.debug("Entering list_calendars")
-    calendar_list = service.calendarList().list().execute()["items"]
+    with GOOGLE_SECONDS.labels(call="calendarList.list").time():
+        calendar_list = service.calendarList().list().execute()["items"]
     result = [ ]
     for cal in calendar_list:
         kind = cal["kind"]
@@ -379,7 +654,8 @@ def meetings(id):
     """
     app.logger.debug(id)
 
-    meeting = collection.find_one( {"_id": ObjectId(id) })
+    with MONGO_SECONDS.labels(op="find_meeting").time():
+        meeting = collection.find_one( {"_id": ObjectId(id) })
     app.logger.debug(meeting)
 
     flask.session['title'] = meeting['title']
@@ -389,24 +665,95 @@ def meetings(id):
     flask.session['start_time'] = arrow.get(meeting['start_time']).format('HH:mm A')
     flask.session['end_time'] = arrow.get(meeting['end_time']).format('HH:mm A')
 
-    free_times = []
-    for free in meeting['free']:
-        free_times.append({
-            "start": arrow.get(free['start']).format('MM/DD/YYYY HH:mm A'),
-            "end": arrow.get(free['end']).format('MM/DD/YYYY HH:mm A')
-        })
-
     if CONFIG.PORT == 5000:
         url = "localhost:5000/invitee/" + id
     else:
         url = "ix.cs.uoregon.edu:8234/participant/" + id
 
     flask.session['url'] = url
-    flask.session['free'] = free_times
+    #[begin, end] UTC epoch pairs, formatted by the page (fmtepoch)
+    flask.session['free'] = meeting['free']
     flask.session['attend'] = meeting['attend']
     app.logger.debug(flask.session['title'])
 
-    return flask.render_template('meeting.html')
+    return render_template('meeting.html')
+
+@app.route('/slots/<id>')
+def best_slots(id):
+    """
+    The best times to hold a meeting, within its free times
+    Query arguments: duration (minutes, 60 by default), k (how many,
+    5 by default), part ("morning" or "afternoon"), buffer (minutes
+    of free time wanted either side)
+    :param id: id of the meeting
+    :return: json with slots, a list of [begin, end] UTC epoch
+        second pairs, best first
+    """
+    duration = request.args.get('duration', 60, type=int)
+    k = min(request.args.get('k', 5, type=int), MAX_SLOTS)
+    if duration <= 0 or k <= 0 or not ObjectId.is_valid(id):
+        return jsonify(slots=[]), 400
+    preferences = { "buffer": 60 * max(0, request.args.get('buffer', 0, type=int)),
+                    "tzinfo": tz.tzlocal() }
+    part = request.args.get('part')
+    if part in ("morning", "afternoon"):
+        preferences['part'] = part
+
+    with MONGO_SECONDS.labels(op="meeting_free").time():
+        meeting = collection.find_one({ "_id": ObjectId(id) },
+                                      { "free": 1, "start_date": 1, "end_date": 1,
+                                        "start_time": 1, "end_time": 1 })
+    if meeting is None:
+        return jsonify(slots=[]), 404
+    #no buffer is needed where the day's window opens or closes
+    window = EventWindow(meeting['start_date'], meeting['end_date'],
+                         meeting['start_time'], meeting['end_time'])
+    days = ArrayAgenda().complement_daily(window.dates, window.times[0],
+                                          window.times[1], "Free", window.tzinfo)
+    preferences['open_edges'] = set(days.begins) | set(days.ends)
+    with AGENDA_SECONDS.labels(op="find_slots").time():
+        free = ArrayAgenda.from_epoch_pairs(meeting['free'], "Free")
+        slots = free.find_slots(60 * duration, k, preferences)
+    return jsonify(slots=slots.epoch_pairs())
+
+@app.route('/attendance/<id>')
+def attendance(id):
+    """
+    How many of those who have answered could come, over the whole
+    meeting window, for when no time suits everyone
+    Query arguments: q (fewest who must be free, everyone by
+    default), duration (minutes, 60 by default), k (how many slots,
+    5 by default)
+    :param id: id of the meeting
+    :return: json with people (how many have answered), coverage, a
+        list of [begin, end, free] covering the window, and slots,
+        the best k [begin, end, free] with at least q free, where
+        begin and end are UTC epoch seconds and free how many could
+        come
+    """
+    duration = request.args.get('duration', 60, type=int)
+    k = min(request.args.get('k', 5, type=int), MAX_SLOTS)
+    if duration <= 0 or k <= 0 or not ObjectId.is_valid(id):
+        return jsonify(coverage=[], slots=[]), 400
+
+    with MONGO_SECONDS.labels(op="find_meeting").time():
+        meeting = collection.find_one({ "_id": ObjectId(id) },
+                                      { "start_date": 1, "end_date": 1,
+                                        "start_time": 1, "end_time": 1 })
+    if meeting is None:
+        return jsonify(coverage=[], slots=[]), 404
+    window = EventWindow(meeting['start_date'], meeting['end_date'],
+                         meeting['start_time'], meeting['end_time'])
+    busy = meeting_busy(ObjectId(id))
+    q = request.args.get('q', len(busy), type=int)
+
+    with AGENDA_SECONDS.labels(op="attendance").time():
+        coverage = Agenda.attendance(busy, window.dates, window.times[0],
+                                     window.times[1], window.tzinfo)
+        slots = Agenda.best_attended(coverage, q, 60 * duration, k)
+    return jsonify(people=len(busy),
+                   coverage=[ list(piece) for piece in coverage ],
+                   slots=[ list(slot) for slot in slots ])
 
 @app.route('/invitee/<id>')
 def invitee(id):
@@ -416,7 +763,8 @@ def invitee(id):
     :return the html page where info is stored.
     """
     app.logger.debug("Entering initee with id: " + id)
-    meeting = collection.find_one( {"_id": ObjectId(id) })
+    with MONGO_SECONDS.labels(op="find_meeting").time():
+        meeting = collection.find_one( {"_id": ObjectId(id) })
 
     #Get info to display
     flask.session['title'] = meeting['title']
@@ -429,11 +777,9 @@ def invitee(id):
     flask.session['Tend_time'] = arrow.get(meeting['end_time']).format('HH:mm A')
     flask.session['start_time'] = interpret_time(meeting['start_time'])
     flask.session['end_time'] = interpret_time(meeting['end_time'])
-    flask.session['final_list'] = meeting['busy']
     flask.session['id'] = id
-    app.logger.debug(meeting['busy'])
 
-    return flask.render_template('invitee.html')
+    return render_template('invitee.html')
 
 
 #####
@@ -443,60 +789,506 @@ def invitee(id):
 #####
 @app.route('/conflicts')
 def find_conflicts():
+    """
+    Starts finding the busy and free times for the calendars picked.
+    Everything the work needs from the session is copied first, so
+    it can run on the job pool after this request has returned.
+    :return: json with the job id to ask /conflicts/<job> about, or
+        with the calendars we couldn't read if CONFLICT_JOBS is off
+    """
     app.logger.debug("Entering find_conflicts")
-    credentials = client.OAuth2Credentials.from_json(flask.session['credentials'])
-    service = get_gcal_service(credentials)
     cals = request.args.get('cals', type=str)
     app.logger.debug(cals)
-    split_cals = cals.split()
-    final_events = []
-    #go through each cal that was selected and check busy times
-    for cal in split_cals:
-        events = service.events().list(calendarId=cal,  pageToken=None).execute()
-        print(events)
-        #for each event within the current calendar
-        for event in events['items']:
-            #if the event is set to transparent skip it
-            if 'transparancy' in event:
+    job = { "credentials": flask.session['credentials'],
+            "cals": cals.split(),
+            "source": request.args.get('source', BUSY_SOURCE, type=str),
+            "user": calendar_user(),
+            #only ask Google for busy times in the days picked
+            "window": EventWindow.from_session(),
+            "invitee": flask.session['invitee'] }
+    if job['invitee'] == True:
+        job['name'] = flask.session.get('name', '').strip()
+        job['id'] = flask.session['id']
+        job['answer'] = flask.session.get('answer')
+        if not job['name'] or not job['answer']:
+            return jsonify(failed=[], error="no name"), 400
+    else:
+        job['meeting'] = { "type": "meeting",
+                           "attend": [],
+                           "start_date": flask.session['begin_date'],
+                           "end_date": flask.session['end_date'],
+                           "start_time": flask.session['start_time'],
+                           "end_time": flask.session['end_time'],
+                           "title": flask.session['title'],
+                           "place": flask.session['place'] }
+
+    if not CONFLICT_JOBS:
+        #let the page know about any calendars we couldn't read
+        return jsonify(failed=run_conflicts(job))
+    job_id = uuid.uuid4().hex
+    with MONGO_SECONDS.labels(op="job_insert").time():
+        jobs.insert_one({ "_id": job_id, "status": "queued",
+                          "created": datetime.datetime.utcnow() })
+    job_pool.submit(run_job, job_id, job)
+    return jsonify(job=job_id)
+
+@app.route('/conflicts/<job_id>')
+def conflicts_status(job_id):
+    """
+    How a job from /conflicts is doing
+    :param job_id: the id /conflicts gave back
+    :return: json with status "queued", "running", "done" (with the
+        calendars we couldn't read as failed) or "error"
+    """
+    with MONGO_SECONDS.labels(op="job_status").time():
+        found = jobs.find_one({ "_id": job_id }, { "_id": 0, "created": 0 })
+    if found is None:
+        return jsonify(status="unknown"), 404
+    return jsonify(**found)
+
+def run_job(job_id, job):
+    """
+    Runs a /conflicts job on the job pool, keeping its status in
+    the db so any server process can answer /conflicts/<job>.
+    """
+    started = time.perf_counter()
+    try:
+        jobs.update_one({ "_id": job_id }, {'$set': { "status": "running" }})
+        failed = run_conflicts(job)
+    except Exception as err:
+        app.logger.exception("Conflicts job {} failed".format(job_id))
+        jobs.update_one({ "_id": job_id },
+                        {'$set': { "status": "error", "error": str(err) }})
+        JOB_SECONDS.labels(status="error").observe(time.perf_counter() - started)
+        return
+    jobs.update_one({ "_id": job_id },
+                    {'$set': { "status": "done", "failed": failed }})
+    JOB_SECONDS.labels(status="done").observe(time.perf_counter() - started)
+
+def run_conflicts(job):
+    """
+    Gets the busy times and stores them and the free times with
+    the meeting, creating it for the organizer.  Uses only the job,
+    never the session.
+    :param job: what find_conflicts copied from the request
+    :return: list of {"calendar", "reason"} for calendars we
+        couldn't read
+    """
+    credentials = client.OAuth2Credentials.from_json(job['credentials'])
+    window = job['window']
+    busy_times = BUSY_SOURCES.get(job['source'], BUSY_SOURCES[BUSY_SOURCE])
+    busy, failed = busy_times(credentials, job['cals'], window, job['user'])
+
+    if job['invitee'] == False:
+        #the organizer's busy times are the only ones so far
+        meeting = dict(job['meeting'])
+        meeting['free'] = find_free([busy], window).epoch_pairs()
+        with MONGO_SECONDS.labels(op="meeting_insert").time():
+            collection.insert_one(meeting)
+        save_busy(meeting['_id'], "", busy)
+        forget_meetings()
+        app.logger.debug(meeting)
+
+    #add name and updated free times list in meeting
+    if job['invitee'] == True:
+        meeting_id = ObjectId(job['id'])
+        answered = save_busy(meeting_id, job['answer'], busy, job['name'])
+        #other invitees may be answering at the same time; the free
+        #list is only written if nobody has written it since we read
+        #it (free_version), otherwise we read it again
+        for attempt in range(FREE_UPDATE_TRIES):
+            with MONGO_SECONDS.labels(op="meeting_free").time():
+                meeting = collection.find_one({ "_id": meeting_id },
+                                              { "free": 1, "free_version": 1 })
+            version = meeting.get('free_version')
+            if answered or attempt > 0:
+                #answering again may free up times, and after a clash
+                #we can't tell what the other writer took out, so
+                #start over from everyone's busy times (all saved
+                #before their free list is written)
+                free = find_free(meeting_busy(meeting_id), window)
+            else:
+                #just take this invitee's busy times out of what's left
+                with AGENDA_SECONDS.labels(op="difference").time():
+                    free = Agenda.from_epoch_pairs(meeting['free'], "Free").difference(busy)
+            with MONGO_SECONDS.labels(op="meeting_update").time():
+                result = collection.update_one(
+                    { "type": "meeting", "_id": meeting_id, "free_version": version },
+                    #a new answer adds its name even if someone else
+                    #gave the same one
+                    {('$addToSet' if answered else '$push'): {'attend': job['name']},
+                     '$set': {'free': free.epoch_pairs()},
+                     '$inc': {'free_version': 1}})
+            if result.matched_count:
+                break
+        else:
+            raise RuntimeError("Free times of meeting {} kept changing".format(meeting_id))
+    return failed
+
+####
+#
+#  Busy time sources: each takes the user's credentials, the
+#  calendar ids, the EventWindow and the calendar_user, and
+#  returns (busy, failed)
+#  where busy is an ArrayAgenda of the conflicting busy times,
+#  in UTC epoch seconds, and failed is a list of
+#  {"calendar", "reason"} dicts for calendars we couldn't read.
+#
+####
+
+def busy_from_events(credentials, cals, window, user=None):
+    """
+    Busy times from listing every event of each calendar.
+    Gives the event summaries as descriptions.
+    """
+    #fetch the selected cals all at once; each worker checks its
+    #pages against the window as they arrive
+    fetched, failed = fetch_calendars(fetch_calendar, credentials, cals, window)
+    busy = ArrayAgenda()
+    for found in fetched:
+        busy.begins.extend(found.begins)
+        busy.ends.extend(found.ends)
+        busy.descs.extend(found.descs)
+    return busy, failed
+
+def busy_from_cache(credentials, cals, window, user=None):
+    """
+    Busy times from the event cache, bringing each calendar up
+    to date first with only the changes since it was last synced
+    (see sync_calendar).  Gives the event summaries as descriptions.
+    Without a user to key the cache on, lists the events instead.
+    """
+    if user is None:
+        return busy_from_events(credentials, cals, window)
+    fetched, failed = fetch_calendars(sync_calendar, credentials, cals, user, window)
+    return busy_in_events(fetched, window), failed
+
+def busy_in_events(fetched, window):
+    """
+    The busy times among lists of events, as an ArrayAgenda of
+    UTC epoch seconds.
+    :param fetched: list of lists of event dicts, one per calendar
+    :param window: EventWindow picked for the meeting
+    """
+    busy = ArrayAgenda()
+    for events in fetched:
+        add_busy(busy, events, window)
+    return busy
+
+def add_busy(busy, events, window):
+    """
+    Add the busy times among a list of events (a calendar, or one
+    page of it) to an ArrayAgenda
+    :param busy: ArrayAgenda of UTC epoch seconds to add to
+    :param events: list of event dicts
+    :param window: EventWindow picked for the meeting
+    """
+    #if the event is set to transparent skip it
+    events = [event for event in events
+              if event.get('transparency') != 'transparent']
+    #check the whole list against the window at once
+    with AGENDA_SECONDS.labels(op="window").time():
+        found = window.conflicts([event_times(event) for event in events])
+    for event, span in zip(events, found):
+        if span is not None and span[0] < span[1]:
+            busy.append_epoch(span[0], span[1], event.get('summary', ''))
+
+def busy_from_freebusy(credentials, cals, window, user=None):
+    """
+    Busy times from the Calendar freebusy query, which returns
+    only the busy intervals, for many calendars per call, instead
+    of whole events.  There are no event summaries, so every busy
+    time is described as "Busy".
+    """
+    busy = ArrayAgenda()
+    failed = []
+    for first in range(0, len(cals), FREEBUSY_MAX_CALENDARS):
+        batch = cals[first:first + FREEBUSY_MAX_CALENDARS]
+        query = { "timeMin": window.time_min,
+                  "timeMax": window.time_max,
+                  "items": [{"id": cal} for cal in batch] }
+        try:
+            with get_gcal_service(credentials, timeout=FETCH_TIMEOUT) as service:
+                with GOOGLE_SECONDS.labels(call="freebusy.query").time():
+                    response = service.freebusy().query(body=query).execute()
+        except Exception as err:
+            app.logger.warning("Freebusy query failed: {}".format(err))
+            failed.extend({"calendar": cal, "reason": str(err)} for cal in batch)
+            continue
+
+        for cal in batch:
+            info = response['calendars'].get(cal, {"errors": [{"reason": "notFound"}]})
+            if info.get('errors'):
+                reason = info['errors'][0]['reason']
+                app.logger.warning("Couldn't fetch calendar {}: {}".format(cal, reason))
+                failed.append({"calendar": cal, "reason": reason})
+                continue
+            periods = info.get('busy', [])
+            with AGENDA_SECONDS.labels(op="window").time():
+                found = window.conflicts([(period['start'], period['end'])
+                                          for period in periods])
+            for span in found:
+                if span is not None and span[0] < span[1]:
+                    busy.append_epoch(span[0], span[1], "Busy")
+    return busy, failed
+
+BUSY_SOURCES = { "cached": busy_from_cache,
+                 "events": busy_from_events,
+                 "freebusy": busy_from_freebusy }
+
+def list_events(service, cal, time_min, time_max):
+    """
+    Generator: the events of one calendar that fall in a time
+    window, a page (list of events) at a time, following
+    nextPageToken.  Google
+    does the windowing and expands recurring events into their
+    instances, and only the fields we use are sent, so the transfer
+    is proportional to the window rather than the calendar's history.
+    :param service: Google calendar service
+    :param cal: id of the calendar
+    :param time_min: ISO date-time, start of the window
+    :param time_max: ISO date-time, end of the window
+    :yield: lists of event dicts
+    """
+    page_token = None
+    timer = GOOGLE_SECONDS.labels(call="events.list")
+    while True:
+        check_fetch_deadline()
+        with timer.time():
+            page = service.events().list(calendarId=cal,
+                                         timeMin=time_min,
+                                         timeMax=time_max,
+                                         singleEvents=True,
+                                         orderBy='startTime',
+                                         fields=EVENT_FIELDS,
+                                         pageToken=page_token).execute()
+        yield page.get('items', [])
+        page_token = page.get('nextPageToken')
+        if not page_token:
+            return
+
+def fetch_calendar(credentials, cal, window):
+    """
+    Runs in a fetch worker: the busy times of one calendar within
+    the meeting window.  Each page of events is checked against
+    the window as it arrives and then dropped, so only the busy
+    times are kept, never the calendar's whole event list.
+    Each worker gets its own service because httplib2
+    connections can't be shared between threads.
+    :param credentials: OAuth2 credentials of the user
+    :param cal: id of the calendar
+    :param window: EventWindow picked for the meeting
+    :return: ArrayAgenda of busy times in UTC epoch seconds
+    """
+    busy = ArrayAgenda()
+    with get_gcal_service(credentials, timeout=FETCH_TIMEOUT) as service:
+        for events in list_events(service, cal, window.time_min, window.time_max):
+            add_busy(busy, events, window)
+    return busy
+
+def sync_calendar(credentials, cal, user, window):
+    """
+    Runs in a fetch worker: bring the cached events of one of a
+    user's calendars up to date and return those in the window.
+
+    The first time, every event is listed and Google hands back
+    a sync token; after that, listing with the token returns only
+    the events added, changed or cancelled since, so a repeat
+    visit costs almost no traffic.  If Google no longer accepts
+    the token (410 Gone) we start over with a full listing.
+    A sync token can't be limited to a time window, so that first
+    listing is the calendar's whole history; events that have
+    already ended are left out of the cache to keep it small.
+    Entries not synced for EVENT_CACHE_TTL are dropped by Mongo.
+    :param credentials: OAuth2 credentials of the user
+    :param cal: id of the calendar
+    :param user: who the calendar is being read for (see calendar_user)
+    :param window: EventWindow picked for the meeting
+    :return: list of the event dicts that overlap the window's dates
+    """
+    key = {"user": user, "calendar": cal}
+    with MONGO_SECONDS.labels(op="cache_load").time():
+        entry = event_cache.find_one(key) or {}
+    token = entry.get('sync_token')
+    busy = entry.get('busy', {}) if token else {}
+    changed = {}
+    removed = set()
+    with get_gcal_service(credentials, timeout=FETCH_TIMEOUT) as service:
+        page_token = None
+        while True:
+            check_fetch_deadline()
+            try:
+                with GOOGLE_SECONDS.labels(call="events.sync").time():
+                    page = service.events().list(calendarId=cal,
+                                                 singleEvents=True,
+                                                 syncToken=token,
+                                                 fields=SYNC_FIELDS,
+                                                 pageToken=page_token).execute()
+            except HttpError as err:
+                if err.resp.status != 410 or token is None:
+                    raise
+                app.logger.debug("Sync token expired for " + cal)
+                token = None
+                busy = {}
+                changed = {}
+                removed = set()
+                page_token = None
                 continue
-            start_time_date = arrow.get(event['start']['dateTime'])
-            end_time_date = arrow.get(event['end']['dateTime'])
-
-            if is_conflict(start_time_date, end_time_date):
-                start = start_time_date.to('local').format('MM/DD/YYYY h:mm A')
-                end = end_time_date.to('local').format('MM/DD/YYYY h:mm A')
-                app.logger.debug(start)
-                final_events.append({
+            for event in page.get('items', []):
+                if (event.get('status') == 'cancelled' or
+                        event.get('transparency') == 'transparent'):
+                    busy.pop(event['id'], None)
+                    changed.pop(event['id'], None)
+                    removed.add(event['id'])
+                    continue
+                removed.discard(event['id'])
+                start, end = event_times(event)
+                busy[event['id']] = changed[event['id']] = {
                     "start": start,
                     "end": end,
-                    "desc": event['summary']
-                })
+                    "summary": event.get('summary', '')
+                }
+            page_token = page.get('nextPageToken')
+            if not page_token:
+                break
+
+    #an event that is over can't be in a meeting window again
+    now = time.time()
+    for id in [id for id, event in busy.items()
+               if event_time(event['end'], window.tzinfo, end=True)[2] <= now]:
+        del busy[id]
+        changed.pop(id, None)
+        removed.add(id)
+
+    synced = {"sync_token": page.get('nextSyncToken'),
+              "synced": datetime.datetime.utcnow()}
+    if token is None:
+        #full listing: replace whatever was there
+        synced['busy'] = busy
+        update = {'$set': synced}
+    else:
+        #only write the events that changed
+        for id, event in changed.items():
+            synced['busy.' + id] = event
+        update = {'$set': synced}
+        if removed:
+            update['$unset'] = dict(('busy.' + id, "") for id in removed)
+    with MONGO_SECONDS.labels(op="cache_save").time():
+        event_cache.update_one(key, update, upsert=True)
+
+    #only what Google would have listed for the window
+    first = arrow.get(window.time_min).timestamp
+    last = arrow.get(window.time_max).timestamp
+    return [{"start": google_time(event['start']),
+             "end": google_time(event['end']),
+             "summary": event['summary']} for event in busy.values()
+            if event_time(event['start'], window.tzinfo)[2] < last
+            and event_time(event['end'], window.tzinfo, end=True)[2] > first]
+
+def google_time(text):
+    """An event time as Google gives it: a date time, or a date
+    for all-day events.
+    """
+    if "T" in text:
+        return {"dateTime": text}
+    return {"date": text}
 
-    if flask.session['invitee'] == True:
-        final_events = final_events + flask.session['final_list']
-        app.logger.debug(final_events)
-
-    free = find_free(final_events)
-    if flask.session['invitee'] == False:
-        meeting = { "type": "meeting",
-                    "attend": [],
-                    "start_date": flask.session['begin_date'],
-                    "end_date": flask.session['end_date'],
-                    "start_time": flask.session['start_time'],
-                    "end_time": flask.session['end_time'],
-                    "title": flask.session['title'],
-                    "place": flask.session['place'],
-                    "free": free,
-                    "busy": final_events
-            }
-        collection.insert(meeting)
-        app.logger.debug(meeting)
+def calendar_user():
+    """
+    Who the selected calendars are being read for, to key the
+    event cache: the id (email address) of the primary calendar
+    we listed for this user, or None if we don't know it.
+    """
+    for cal in flask.session.get('calendars', []):
+        if cal['primary']:
+            return cal['id']
+    return None
 
-    #add name and updated free times list in meeting
-    if flask.session['invitee'] == True:
-        collection.update({ "type": "meeting", "_id": ObjectId(flask.session['id']) }, {'$push': {'attend':flask.session['name']}})
-        collection.update_one({ '_id': ObjectId(flask.session['id'])},{'$set': { 'free': free}})
-    return "none"
+class FetchTimeout(Exception):
+    """A calendar took more than FETCH_TIMEOUT to read."""
+
+def check_fetch_deadline():
+    """
+    Called before each page request: give up on a calendar once
+    it has had FETCH_TIMEOUT, however many pages it has left.
+    The httplib2 timeout only bounds each socket operation.
+    """
+    deadline = getattr(fetch_deadline, 'at', None)
+    if deadline is not None and time.monotonic() > deadline:
+        raise FetchTimeout("timed out")
+
+def start_fetch(started, index, fetch, credentials, cal, args):
+    """
+    Runs in a fetch worker: note when the fetch of calendar cal
+    really started, so its FETCH_TIMEOUT counts from here and
+    not from when it was queued behind other requests' fetches.
+    """
+    started[index] = time.monotonic()
+    fetch_deadline.at = started[index] + FETCH_TIMEOUT
+    try:
+        return fetch(credentials, cal, *args)
+    finally:
+        fetch_deadline.at = None
+
+def fetch_calendars(fetch, credentials, cals, *args):
+    """
+    Fetch several calendars concurrently on the fetch pool, so
+    the wait is about that of the slowest calendar rather than
+    the sum of them all.  Each calendar gets FETCH_TIMEOUT from
+    when a worker starts on it; time spent queued (the pool is
+    shared by every request and job) doesn't count.
+    :param fetch: worker function, fetch(credentials, cal, *args)
+        returns what was read of calendar cal (its events, or
+        its busy times)
+    :param credentials: OAuth2 credentials of the user
+    :param cals: list of calendar ids
+    :param args: passed on to fetch
+    :return: (fetched, failed) where fetched is a list of what
+        fetch returned, in the order of cals, for the calendars that
+        could be read, and failed is a list of {"calendar", "reason"}
+        dicts for the ones that errored or timed out
+    """
+    started = [None] * len(cals)
+    futures = [fetch_pool.submit(start_fetch, started, index, fetch,
+                                 credentials, cal, args)
+               for index, cal in enumerate(cals)]
+    pending = set(futures)
+    timed_out = set()
+    while pending:
+        now = time.monotonic()
+        waits = []
+        for index, future in enumerate(futures):
+            if future not in pending or started[index] is None:
+                continue
+            left = started[index] + FETCH_TIMEOUT - now
+            if left <= 0:
+                #the worker stops at its next page
+                timed_out.add(future)
+                pending.discard(future)
+            else:
+                waits.append(left)
+        if not pending:
+            break
+        if len(waits) < len(pending):
+            #some haven't started; look again for when they do
+            waits.append(FETCH_POLL)
+        done, pending = wait(pending, timeout=min(waits),
+                             return_when=FIRST_COMPLETED)
+
+    fetched = []
+    failed = []
+    for cal, future in zip(cals, futures):
+        if future in timed_out:
+            reason = "timed out"
+        else:
+            try:
+                fetched.append(future.result())
+                continue
+            except Exception as err:
+                reason = str(err)
+        app.logger.warning("Couldn't fetch calendar {}: {}".format(cal, reason))
+        failed.append({"calendar": cal, "reason": reason})
+    return fetched, failed
 
 ###################
 #
@@ -513,11 +1305,10 @@ def delete():
     meetings = request.args.get("meetings", type=str)
     app.logger.debug("Meeting Ids: " + meetings)
 
-    remove_memos(meetings)
-    #return garbage
+    deleted = remove_memos(meetings)
+    forget_meetings([id for id in deleted if deleted[id]])
     rslt = True
-    init_session_values()
-    return jsonify(result=rslt)
+    return jsonify(result=rslt, deleted=deleted)
 
 ###########
 #
@@ -526,110 +1317,203 @@ def delete():
 ##########
 def remove_memos(meetings):
     """
-    :param mems: list of memo ids
-    :return: nothing
+    Deletes DELETE_BATCH meetings per round trip to the db
+    rather than one at a time.
+    :param meetings: space separated meeting ids
+    :return: dict of id -> number of meetings deleted with
+        that id (0 if there was none, or the id isn't valid)
     """
     #Split it up so we can search for multiple _ids
-    ids = meetings.split(" ")
-    for id in ids:
-        if id == '':
-            continue
-        collection.delete_one({'_id': ObjectId(id)})
-    return
-
-def fold_times(free, events):
-    """
-    Takes the list of free times and list of events folds them together
-    :param free: dict of free times
-    :param events: dict of busy events
-    :return: none
-    """
-    times = []
-    for free_time in free:
-        times.append(free_time)
-    for busy_time in events:
-        #have to do this so the lambda sort works properly
-        busy_time['start'] = arrow.get(busy_time['start'], 'MM/DD/YYYY h:mm A').isoformat()
-        busy_time['end'] = arrow.get(busy_time['end'], 'MM/DD/YYYY h:mm A').isoformat()
-        times.append(busy_time)
-
-    times.sort(key=lambda t: t['start'])
-    final_times = []
-
-    #now convert back to human readable
-    for event in times:
-        cur_event = {
-            "desc": event['desc'],
-            "start": arrow.get(event['start']).format('MM/DD/YYYY h:mm A'),
-            "end": arrow.get(event['end']).format('MM/DD/YYYY h:mm A')
-        }
-        final_times.append(cur_event)
-
-    flask.session['final_list'] = final_times
-    app.logger.debug(final_times)
-    return "none"
+    ids = [id for id in meetings.split(" ") if id != '']
+    deleted = dict((id, 0) for id in ids)
+    object_ids = [ObjectId(id) for id in ids if ObjectId.is_valid(id)]
+    for first in range(0, len(object_ids), DELETE_BATCH):
+        batch = object_ids[first:first + DELETE_BATCH]
+        #which of them are really there, so we can report per id
+        with MONGO_SECONDS.labels(op="delete").time():
+            found = [meeting['_id'] for meeting in
+                     collection.find({'_id': {'$in': batch}}, {'_id': 1})]
+            if not found:
+                continue
+            result = collection.delete_many({'_id': {'$in': found}})
+            busy_collection.delete_many({'meeting': {'$in': found}})
+        app.logger.debug("Deleted {} meetings".format(result.deleted_count))
+        for object_id in found:
+            deleted[str(object_id)] = 1
+    return deleted
+
+def save_busy(meeting_id, invitee, busy, name=""):
+    """
+    Stores one participant's busy times in their own document,
+    replacing what they sent before
+    :param meeting_id: ObjectId of the meeting
+    :param invitee: the id of the invitee's answer, "" for the organizer
+    :param busy: Agenda of their busy times
+    :param name: the name the invitee gave
+    :return: True if they had answered before
+    """
+    with MONGO_SECONDS.labels(op="busy_save").time():
+        result = busy_collection.update_one({ "meeting": meeting_id, "invitee": invitee },
+                                            {'$set': { "busy": busy.epoch_pairs(),
+                                                       "name": name }},
+                                            upsert=True)
+    return result.matched_count > 0
+
+def meeting_busy(meeting_id):
+    """
+    Loads the busy times of everyone who has answered for a meeting
+    :param meeting_id: ObjectId of the meeting
+    :return: list of busy Agendas, one per participant
+    """
+    with MONGO_SECONDS.labels(op="busy_load").time():
+        return [ ArrayAgenda.from_epoch_pairs(doc['busy'], "Busy") for doc in
+                 busy_collection.find({ "meeting": meeting_id }, { "busy": 1 }) ]
 
 #######
 #
 # Finds free times given a list of busy times.
 #
 ######
-def find_free(events):
+def find_free(agendas, window):
     """
     uses the not free events to find the free blocks
-    :param events: dict of busy events
-    :return: dict of free times
+    :param agendas: list of busy Agendas, e.g. one per participant
+    :param window: EventWindow picked for the meeting
+    :return: Agenda of free times
     """
-    #pass in the event list
-    agenda = Agenda.from_dict(events)
+    #merged in a single pass by common_free_daily
     app.logger.debug("Find Free Events")
 
-    #Just get all the block in questions info
-    start_date = arrow.get(flask.session['begin_date']).date()
-    end_date = arrow.get(flask.session['end_date']).date()
-    start_time = arrow.get(flask.session['start_time']).time()
-    end_time = arrow.get(flask.session['end_time']).time()
-
-    #Make two arrow objects for freeblock query
-    begin = arrow.Arrow(start_date.year, start_date.month, start_date.day, start_time.hour, start_time.minute)
-    end = arrow.Arrow(end_date.year, end_date.month, end_date.day, end_time.hour, end_time.minute)
-
-    free = Appt(begin, end, "Free")
-    free_time = agenda.complement(free)
-    app.logger.debug(free_time.list_convert())
-
-    #convert to dict for later use
-    return free_time.list_convert()
-
-
-def is_conflict(start, end):
-        devent_start_end = [ start.date(), end.date()]
-        tevent_start_end = [ start.time(), end.time()]
-        app.logger.debug(flask.session['begin_date'])
-        dselected_start_end = [ arrow.get(flask.session['begin_date']).date(), arrow.get(flask.session['end_date']).date()]
-        tselected_start_end = [ arrow.get(flask.session['start_time']).time(), arrow.get(flask.session['end_time']).time()]
-        app.logger.debug(dselected_start_end)
-        app.logger.debug(tselected_start_end)
-        app.logger.debug(devent_start_end)
-        app.logger.debug(tevent_start_end)
-
-        #if the date falls between start and dates picked and during event return true
-        if not (dselected_start_end[0] <= devent_start_end[0] <= dselected_start_end[1]) or not (dselected_start_end[0] <= devent_start_end[1] <= dselected_start_end[1]):
-            app.logger.debug("'{}' <= '{}' <= '{}'".format(dselected_start_end[0], devent_start_end[0], dselected_start_end[1]))
-            return False
-        elif tevent_start_end[1] <= tselected_start_end[0]:
-            app.logger.debug("Hello from time")
-            return False
-        elif tevent_start_end[0] >= tselected_start_end[1]:
-            return False
-        else:
-            return True
+    #only the start to end time window on each day counts as free,
+    #not the hours overnight
+    with AGENDA_SECONDS.labels(op="find_free").time():
+        free_time = Agenda.common_free_daily(agendas, window.dates,
+                                             window.times[0], window.times[1], "Free",
+                                             window.tzinfo)
+    app.logger.debug("{} free times".format(len(free_time)))
+
+    return free_time
+
+
+## Google's event times: RFC 3339 date times, e.g.
+## 2016-03-01T09:00:00-08:00 or 2016-03-01T17:00:00.000Z, or just
+## a date, 2016-03-01, for all-day events
+RFC3339 = re.compile(r"(\d{4})-(\d\d)-(\d\d)"
+                     r"(?:T(\d\d):(\d\d):(\d\d)(?:\.\d+)?(Z|[+-]\d\d:\d\d))?$")
+
+def event_time(text, tzinfo, end=False):
+  """
+  Reads a Google event time, once, into what we need: the date (as
+  an ordinal) and time of day (in seconds) it falls on in the
+  window's time zone, and the moment as UTC epoch seconds.  Google
+  gives events in their calendar's zone and freebusy periods in
+  UTC, so the offset in the text is only used to find the moment.
+  :param text: RFC 3339 date time, or a date for all-day events
+  :param tzinfo: time zone of the window; all-day events are
+      taken to be in it too
+  :param end: True if text is when an event ends; all-day events
+      end at the start of the day after their last day, which we
+      read as the end of that last day
+  :return: (date ordinal, seconds since midnight, epoch seconds)
+  """
+  match = RFC3339.match(text)
+  if match is None:
+    epoch = arrow.get(text).timestamp
+  else:
+    year, month, day, hour, minute, second, offset = match.groups()
+    date = datetime.date(int(year), int(month), int(day))
+    if hour is None:
+      epoch = int(datetime.datetime.combine(date, datetime.time())
+                  .replace(tzinfo=tzinfo).timestamp())
+      if end:
+        return (date.toordinal() - 1, SECONDS_PER_DAY, epoch)
+      return (date.toordinal(), 0, epoch)
+    shift = 0
+    if offset != "Z":
+      shift = int(offset[1:3]) * 3600 + int(offset[4:6]) * 60
+      if offset[0] == "-":
+        shift = -shift
+    epoch = ((date.toordinal() - EPOCH_ORDINAL) * SECONDS_PER_DAY
+             + int(hour) * 3600 + int(minute) * 60 + int(second) - shift)
+  local = datetime.datetime.fromtimestamp(epoch, tzinfo)
+  return (local.toordinal(),
+          local.hour * 3600 + local.minute * 60 + local.second, epoch)
+
+def event_times(event):
+  """The (start, end) of a Google event as it gives them, date times
+  or dates for an all-day event.
+  """
+  start = event['start']
+  end = event['end']
+  return (start.get('dateTime') or start['date'], end.get('dateTime') or end['date'])
+
+class EventWindow:
+  """
+  The days and the time of day picked for a meeting, parsed once
+  so a whole page of events can be checked against them in one
+  pass.  An event conflicts when it starts and ends on days in the
+  range and overlaps the time of day.
+  """
+
+  def __init__(self, begin_date, end_date, start_time, end_time, tzinfo=None):
+    """
+    :param begin_date, end_date: ISO dates, both days included
+    :param start_time, end_time: ISO times, the window each day
+    :param tzinfo: time zone of the window, the server's own by
+        default (as for interpret_date and interpret_time)
+    """
+    self.tzinfo = tzinfo if tzinfo is not None else tz.tzlocal()
+    #what to ask Google for
+    self.time_min = begin_date
+    self.time_max = next_day(end_date)
+    #as dates and times for find_free
+    self.dates = (arrow.get(begin_date).date(), arrow.get(end_date).date())
+    start = arrow.get(start_time)
+    end = arrow.get(end_time)
+    self.times = (start.time(), end.time())
+    #and as numbers for conflicts
+    self.first_day = self.dates[0].toordinal()
+    self.last_day = self.dates[1].toordinal()
+    self.day_start = (start.hour * 3600 + start.minute * 60 + start.second
+                      + start.microsecond / 1e6)
+    self.day_end = end.hour * 3600 + end.minute * 60 + end.second + end.microsecond / 1e6
+
+  @classmethod
+  def from_session(cls):
+    """The window picked in this session."""
+    return cls(flask.session['begin_date'], flask.session['end_date'],
+               flask.session['start_time'], flask.session['end_time'])
+
+  def conflicts(self, spans):
+    """
+    Which spans conflict with the window, reading each time once
+    :param spans: list of (start, end) Google event times (see
+        event_time)
+    :return: list with the (begin, end) UTC epoch seconds of each
+        span that conflicts, and None for each that doesn't
+    """
+    first, last = self.first_day, self.last_day
+    day_start, day_end = self.day_start, self.day_end
+    found = []
+    for start, end in spans:
+      start_day, start_time, begins = event_time(start, self.tzinfo)
+      end_day, end_time, ends = event_time(end, self.tzinfo, end=True)
+      if (first <= start_day <= last and first <= end_day <= last
+          and end_time > day_start and start_time < day_end):
+        found.append((begins, ends))
+      else:
+        found.append(None)
+    if LOG_EVENTS:
+      for span, conflict in zip(spans, found):
+        app.logger.debug("{} - {} conflicts: {}".format(span[0], span[1], conflict))
+    return found
 
 @app.route('/busy')
 def print_busy():
-    #really does nothing but re-renders index.html once the session['final_list'] is filled
+    #really does nothing but re-renders index.html with the meeting list
     init_session_values()
-    return render_template('index.html')
+    meetings, more = list_meetings()
+    return render_template('index.html', meetings=meetings, more=more)
 
 @app.route('/done')
 def done():
@@ -677,8 +1561,53 @@ def format_arrow_time( time ):
     except:
         return "(bad time)"
 
+@app.template_filter( 'fmtepoch' )
+def format_epoch( epoch ):
+    try:
+        normal = arrow.get( epoch ).to('local')
+        return normal.format("MM/DD/YYYY h:mm A")
+    except:
+        return "(bad time)"
+
 #############
 
+def migrate_meetings():
+    """
+    Upgrades meetings stored before free times were epoch pairs,
+    when free was a list of {"start", "end", "desc"} dicts of ISO
+    times and the organizer's busy times were embedded in the
+    meeting as "busy".  Invitees' answers only ever changed the
+    free list, so their busy times can't be told apart from the
+    organizer's: everything in the window that wasn't free is
+    stored as the organizer's busy document, so later answers
+    (and recomputing) still leave it out.
+    Safe to run more than once, or from several processes.
+    :return: how many meetings were upgraded
+    """
+    upgraded = 0
+    for meeting in collection.find({ "type": "meeting", "busy": { "$exists": True } }):
+        free = [ [arrow.get(block['start']).timestamp, arrow.get(block['end']).timestamp]
+                 if isinstance(block, dict) else block
+                 for block in meeting.get('free', []) ]
+        window = EventWindow(meeting['start_date'], meeting['end_date'],
+                             meeting['start_time'], meeting['end_time'])
+        busy = ArrayAgenda.from_epoch_pairs(free).complement_daily(
+            window.dates, window.times[0], window.times[1], "Busy", window.tzinfo)
+        busy_collection.update_one({ "meeting": meeting['_id'], "invitee": "" },
+                                   {'$setOnInsert': { "busy": busy.epoch_pairs() }},
+                                   upsert=True)
+        result = collection.update_one({ "_id": meeting['_id'], "busy": { "$exists": True } },
+                                       {'$set': { "free": free }, '$unset': { "busy": "" }})
+        upgraded += result.modified_count
+    if upgraded:
+        app.logger.info("Upgraded {} meetings to epoch free times".format(upgraded))
+        forget_meetings()
+    return upgraded
+
+#each process checks at startup; once every meeting is upgraded
+#this finds nothing
+migrate_meetings()
+
 
 if __name__ == "__main__":
   # App is created above so that it will
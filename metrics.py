@@ -0,0 +1,204 @@
+"""
+Timing histograms and counters for the MeetMe app, shown in the
+Prometheus text format on /metrics.
+
+Recording a time or a count only adds to a few numbers under a
+lock; nothing is formatted until someone asks for /metrics.
+
+    GOOGLE_SECONDS = Histogram("meetme_google_seconds",
+                               "Time in Google API calls", ["call"])
+    with GOOGLE_SECONDS.labels(call="events.list").time():
+        page = request.execute()
+"""
+
+import bisect
+import threading
+import time
+
+## Upper bounds (seconds) of the histogram buckets, as in the
+## Prometheus client libraries
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5,
+                   0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+## The content type /metrics is served as
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Registry:
+    """The metrics to show on /metrics."""
+
+    def __init__(self):
+        self.metrics = [ ]
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def render(self):
+        """All the metrics in the Prometheus text format."""
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = [ ]
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, _escape_help(metric.help)))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+
+def _escape_help(text):
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    """{name="value",...} for a sample, or "" if there are no labels."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                         .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """What counters and histograms have in common: a child per
+    combination of label values, made the first time it is used.
+    """
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = { }
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.children[()] = self._child()
+        registry.register(self)
+
+    def labels(self, **labels):
+        """The child for these label values.  Keep it in a variable
+        if it is used often; looking it up isn't free.
+        """
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self._child())
+        return child
+
+    def _sorted_children(self):
+        with self.lock:
+            return sorted(self.children.items())
+
+
+class _CounterChild:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """A count that only goes up, e.g. requests served."""
+    kind = "counter"
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        """Count amount more, for a counter without labels."""
+        self.children[()].inc(amount)
+
+    def samples(self):
+        for key, child in self._sorted_children():
+            yield "{}{} {}".format(self.name, _labels(self.labelnames, key),
+                                   _number(child.value))
+
+
+class _Timer:
+    """Times a with block into a histogram."""
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+        return False
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        #counts[i] is how many were at most bounds[i] and more than
+        #bounds[i - 1]; the last is for those above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """with histogram.time(): ... records how long the block took."""
+        return _Timer(self)
+
+
+class Histogram(_Metric):
+    """How values (usually times in seconds) are spread over buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        self.bounds = tuple(sorted(buckets))
+        _Metric.__init__(self, name, help, labelnames, registry)
+
+    def _child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        """Record value, for a histogram without labels."""
+        self.children[()].observe(value)
+
+    def time(self):
+        """Time a with block, for a histogram without labels."""
+        return self.children[()].time()
+
+    def samples(self):
+        for key, child in self._sorted_children():
+            with child.lock:
+                counts = list(child.counts)
+                total = child.sum
+            seen = 0
+            for bound, count in zip(self.bounds + (float("inf"),), counts):
+                seen += count
+                yield "{}_bucket{} {}".format(
+                    self.name,
+                    _labels(self.labelnames, key, [("le", _number(bound))]), seen)
+            yield "{}_sum{} {}".format(self.name, _labels(self.labelnames, key),
+                                       _number(total))
+            yield "{}_count{} {}".format(self.name, _labels(self.labelnames, key), seen)
@@ -0,0 +1,223 @@
+"""
+Server side sessions for the MeetMe app.
+
+Flask's own session is a signed cookie, so everything in it
+(calendars, free times, busy lists ...) goes back and forth on
+every request.  With this session interface the cookie holds only
+an opaque random id.  The values stay on the server, each key is
+loaded the first time a request asks for it, and only the keys a
+request set or deleted are written back.
+
+Like Flask's session, changing a value in place (appending to a
+list in the session, say) is not noticed; assign it again.
+
+Two stores: MongoStore for running the app, MemoryStore for
+a single process (development and tests).
+"""
+
+import copy
+import threading
+import time
+import uuid
+import datetime
+from collections.abc import MutableMapping
+
+from flask.sessions import SessionInterface, SessionMixin
+
+
+class LazySession(SessionMixin, MutableMapping):
+    """A session that loads keys from a store as they are asked
+    for and remembers which keys were changed.
+    """
+
+    def __init__(self, sid, store, new=False):
+        """
+        :param sid: the session id from the cookie (or a new one)
+        :param store: MongoStore or MemoryStore holding the values
+        :param new: True if nothing is stored for sid yet
+        """
+        self.sid = sid
+        self.store = store
+        self.new = new
+        self.found = False     # True once a key came from the store
+        self.loaded = { }      # key -> value, read or set this request
+        self.missing = set()   # keys we know are not stored
+        self.dirty = set()     # keys set this request
+        self.removed = set()   # keys deleted this request
+        self.modified = False
+
+    def __getitem__(self, key):
+        if key in self.loaded:
+            return self.loaded[key]
+        if self.new or key in self.missing:
+            raise KeyError(key)
+        try:
+            value = self.store.load(self.sid, key)
+        except KeyError:
+            self.missing.add(key)
+            raise
+        self.found = True
+        self.loaded[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.loaded[key] = value
+        self.dirty.add(key)
+        self.removed.discard(key)
+        self.missing.discard(key)
+        self.modified = True
+
+    def __delitem__(self, key):
+        self[key]   # KeyError if there is no such key
+        del self.loaded[key]
+        self.dirty.discard(key)
+        self.removed.add(key)
+        self.missing.add(key)
+        self.modified = True
+
+    def _keys(self):
+        """All keys, which does need a trip to the store."""
+        stored = set() if self.new else set(self.store.keys(self.sid))
+        return (stored | set(self.loaded)) - self.removed
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def clear(self):
+        """Remove every key, loading none of their values."""
+        for key in self._keys():
+            self.loaded.pop(key, None)
+            self.dirty.discard(key)
+            self.removed.add(key)
+            self.missing.add(key)
+        self.modified = True
+
+
+class MemoryStore:
+    """Session values in a dict, for one process.  Entries not
+    saved for ttl seconds are dropped.
+    """
+
+    def __init__(self, ttl=24 * 60 * 60):
+        self.ttl = ttl
+        self.sessions = { }    # sid -> (last saved, {key: value})
+        self.lock = threading.Lock()
+        self.purged = time.time()
+
+    def load(self, sid, key):
+        """The value of key in session sid; KeyError if none."""
+        with self.lock:
+            entry = self.sessions.get(sid)
+            if entry is None or key not in entry[1]:
+                raise KeyError(key)
+            #copied, so a request can't change what is stored
+            return copy.deepcopy(entry[1][key])
+
+    def keys(self, sid):
+        """The keys stored for session sid."""
+        with self.lock:
+            entry = self.sessions.get(sid)
+            return list(entry[1]) if entry is not None else [ ]
+
+    def exists(self, sid):
+        """True if anything is stored for session sid."""
+        with self.lock:
+            return sid in self.sessions
+
+    def save(self, sid, changed, removed):
+        """Store the changed {key: value}s and remove the removed
+        keys of session sid.
+        """
+        now = time.time()
+        with self.lock:
+            values = self.sessions.get(sid, (now, { }))[1]
+            values.update(copy.deepcopy(changed))
+            for key in removed:
+                values.pop(key, None)
+            self.sessions[sid] = (now, values)
+            if now - self.purged > 60:
+                self.purged = now
+                for stale in [ sid for sid, entry in self.sessions.items()
+                               if now - entry[0] > self.ttl ]:
+                    del self.sessions[stale]
+
+
+class MongoStore:
+    """Session values in a Mongo collection, one document per
+    session: { _id: sid, values: { key: value }, saved: date }.
+    A TTL index drops documents not saved for ttl seconds.
+    Session keys must be usable as Mongo field names.
+    """
+
+    def __init__(self, collection, ttl=24 * 60 * 60):
+        self.collection = collection
+        self.collection.create_index("saved", expireAfterSeconds=ttl)
+
+    def load(self, sid, key):
+        """The value of key in session sid; KeyError if none."""
+        doc = self.collection.find_one({ "_id": sid }, { "values." + key: 1 })
+        if doc is None or key not in doc.get("values", { }):
+            raise KeyError(key)
+        return doc["values"][key]
+
+    def keys(self, sid):
+        """The keys stored for session sid."""
+        #there is no projection for just the field names
+        doc = self.collection.find_one({ "_id": sid }, { "values": 1 })
+        return list(doc["values"]) if doc is not None else [ ]
+
+    def exists(self, sid):
+        """True if anything is stored for session sid."""
+        return self.collection.find_one({ "_id": sid }, { "_id": 1 }) is not None
+
+    def save(self, sid, changed, removed):
+        """Store the changed {key: value}s and remove the removed
+        keys of session sid, in one update.
+        """
+        update = { '$set': { "saved": datetime.datetime.utcnow() } }
+        for key, value in changed.items():
+            update['$set']["values." + key] = value
+        if removed:
+            update['$unset'] = dict(("values." + key, "") for key in removed)
+        self.collection.update_one({ "_id": sid }, update, upsert=True)
+
+
+class StoredSessionInterface(SessionInterface):
+    """Flask session interface keeping only the session id in the
+    cookie and the values in a MongoStore or MemoryStore.
+
+    Use with:  app.session_interface = StoredSessionInterface(store)
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid is None:
+            return LazySession(uuid.uuid4().hex, self.store, new=True)
+        #not checked against the store here; an unknown or expired
+        #id just has no keys, and gets a new id once something is set
+        return LazySession(sid, self.store)
+
+    def save_session(self, app, session, response):
+        if not (session.dirty or session.removed):
+            return
+        if not (session.new or session.found or self.store.exists(session.sid)):
+            #the id in the cookie was never ours, or has expired;
+            #don't let a client pick its own session id
+            session.sid = uuid.uuid4().hex
+            session.new = True
+        self.store.save(session.sid,
+                        dict((key, session.loaded[key]) for key in session.dirty),
+                        session.removed)
+        if session.new:
+            response.set_cookie(app.config['SESSION_COOKIE_NAME'], session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=self.get_cookie_domain(app),
+                                path=self.get_cookie_path(app),
+                                secure=self.get_cookie_secure(app))
@@ -125,3 +125,352 @@ def selftest2_agenda():
     assert str(simple_ag) == ""
     # And the freeblock should not be altered
     assert str(lunch) == "12/01/2013 12:30 PM to 12/01/2013 2:30 PM| lunch"
+
+def random_agenda(rand, count, base, first=0, last=200, longest=12, label="appt"):
+    """An Agenda of count appointments on quarter hours, beginning
+    between first and last quarter hours after base and lasting up
+    to longest quarter hours, described as label0, label1, ...
+    """
+    agenda = Agenda()
+    for i in range(count):
+        begin = base.replace(minutes=+15 * rand.randint(first, last))
+        end = begin.replace(minutes=+15 * rand.randint(1, longest))
+        agenda.append(Appt(begin, end, label + str(i)))
+    return agenda
+
+def selftest_intersect_sweep():
+    """The sweep-line intersect must agree with the naive reference."""
+    import random
+    rand = random.Random(399)
+    base = arrow.get("2016-03-01T08:00:00")
+
+    for trial in range(20):
+        mine = random_agenda(rand, rand.randint(0, 40), base, label="mine")
+        theirs = random_agenda(rand, rand.randint(0, 40), base, label="theirs")
+        assert mine.intersect(theirs) == mine.intersect_naive(theirs)
+        assert str(mine.intersect(theirs)) == str(mine.intersect_naive(theirs))
+        assert (str(mine.intersect(theirs, "common")) ==
+                str(mine.intersect_naive(theirs, "common")))
+
+def selftest_array_agenda():
+    """ArrayAgenda must give the same answers as the list-backed Agenda."""
+    import random
+    rand = random.Random(2016)
+    base = arrow.get("2016-03-01T08:00:00")
+    day = Appt(base, base.replace(hours=+10), "Free")
+
+    for trial in range(20):
+        listed = random_agenda(rand, rand.randint(0, 40), base, -8, 48, 8, "busy")
+        other = Agenda()
+        for i in range(rand.randint(0, 10)):
+            begin = base.replace(minutes=+30 * rand.randint(0, 20))
+            other.append(Appt(begin, begin.replace(hours=+1), "other"))
+        arrayed = ArrayAgenda.from_agenda(listed)
+        assert len(arrayed) == len(listed)
+
+        assert str(arrayed.intersect(other)) == str(listed.intersect(other))
+        assert arrayed.intersect(other) == listed.intersect(other)
+        assert str(arrayed.complement(day)) == str(listed.complement(day))
+        assert arrayed.complement(day) == listed.complement(day)
+        arrayed.normalize()
+        listed.normalize()
+        assert str(arrayed) == str(listed)
+        assert arrayed == listed
+
+def selftest_intersect_many():
+    """N-way intersect and common free time against the pairwise path."""
+    import random
+    rand = random.Random(1234)
+    base = arrow.get("2016-03-01T08:00:00")
+    day = Appt(base, base.replace(hours=+10), "Free")
+
+    for trial in range(20):
+        agendas = [ random_agenda(rand, rand.randint(0, 15), base, -8, 48)
+                    for i in range(rand.randint(1, 6)) ]
+
+        chained = agendas[0].normalized()
+        everyone = Agenda()
+        for agenda in agendas:
+            chained = chained.intersect(agenda.normalized())
+            everyone.appts.extend(agenda.appts)
+        assert Agenda.intersect_many(agendas) == chained
+        assert str(Agenda.intersect_many(agendas)) == str(chained)
+
+        assert Agenda.common_free(agendas, day) == everyone.complement(day)
+    assert len(Agenda.intersect_many([ ])) == 0
+
+def selftest_complement_daily():
+    """Daily-window complement against one complement per day."""
+    import random
+    import datetime
+    rand = random.Random(42)
+    base = arrow.get("2016-03-01T00:00:00")
+    busy = Agenda()
+    for i in range(200):
+        begin = base.replace(minutes=+30 * rand.randint(0, 48 * 20))
+        busy.append(Appt(begin, begin.replace(minutes=+30 * rand.randint(1, 20)),
+                         "busy"))
+    first = datetime.date(2016, 3, 2)
+    last = datetime.date(2016, 3, 15)
+    nine = datetime.time(9, 0)
+    five = datetime.time(17, 0)
+
+    expected = Agenda()
+    day = arrow.get(first)
+    while day.date() <= last:
+        window = Appt(day.replace(hours=+9), day.replace(hours=+17), "Free")
+        expected.appts.extend(busy.complement(window).appts)
+        day = day.replace(days=+1)
+
+    assert busy.complement_daily((first, last), nine, five) == expected
+    arrayed = ArrayAgenda.from_agenda(busy)
+    assert arrayed.complement_daily((first, last), nine, five) == expected
+    assert (Agenda.common_free_daily([ busy, Agenda() ], (first, last),
+                                     nine, five) == expected)
+    assert len(Agenda().complement_daily((first, first), nine, five)) == 1
+    try:
+        busy.complement_daily((first, last), five, nine)
+        assert False, "window ends before it begins"
+    except ValueError:
+        pass
+
+def selftest_complement_daily_zone():
+    """Daily windows in a local time zone, across a daylight saving change."""
+    import datetime
+    from dateutil import tz
+    pacific = tz.gettz("US/Pacific")
+    busy = Agenda()
+    busy.append(Appt(arrow.Arrow(2016, 3, 12, 11, 0, tzinfo=pacific),
+                     arrow.Arrow(2016, 3, 14, 9, 30, tzinfo=pacific), "away"))
+    first = datetime.date(2016, 3, 11)
+    last = datetime.date(2016, 3, 14)
+
+    expected = Agenda()
+    for day in range(11, 15):
+        window = Appt(arrow.Arrow(2016, 3, day, 9, 0, tzinfo=pacific),
+                      arrow.Arrow(2016, 3, day, 17, 0, tzinfo=pacific), "Free")
+        expected.appts.extend(busy.complement(window).appts)
+
+    free = busy.complement_daily((first, last), datetime.time(9, 0),
+                                 datetime.time(17, 0), tzinfo=pacific)
+    assert free == expected
+    #nine in the morning is 17:00 UTC before the change, 16:00 after
+    assert [ appt.begin.hour for appt in free ] == [ 17, 17, 16 ]
+    assert [ appt.end.hour for appt in free ] == [ 1, 19, 0 ]
+    assert (Agenda.common_free_daily([ busy ], (first, last), datetime.time(9, 0),
+                                     datetime.time(17, 0), tzinfo=pacific) == expected)
+
+def selftest_time_format():
+    """The precompiled parser must agree with arrow.get, errors included."""
+    samples = [ "10/31/2012 2:30 PM", "12/01/2012 12:00 AM",
+                "12/01/2012 12:15 pm", "on 01/02/2013 1:05 am!",
+                "1/2/2013 1:05 am", "13/40/2013 1:05 am", "bogus" ]
+    for fmt in [ "MM/DD/YYYY h:mm A", "MM-DD-YYYY h:mm A" ]:
+        for memo_size in [ 0, 16 ]:
+            parser = TimeFormat(fmt, memo_size)
+            for text in samples:
+                try:
+                    expected = arrow.get(text, fmt)
+                except Exception as err:
+                    expected = (type(err), str(err))
+                try:
+                    actual = parser.parse(text)
+                except Exception as err:
+                    actual = (type(err), str(err))
+                assert actual == expected
+
+def selftest_iter_file():
+    """Streaming reads collect errors and feed the stream helpers."""
+    agtxt = """# sorted export
+    12-01-2013 9:00 AM to 12-01-2013 10:30 AM| standup
+    12-01-2013 10:00 AM to 12-01-2013 11:00 AM| review
+    not an appointment
+    12-01-2013 1:00 PM to 12-01-2013 2:00 PM
+    12-01-2013 3:00 PM to 12-01-2013 2:00 PM| backwards
+    12-01-2013 4:00 PM to 12-01-2013 5:00 PM| retro
+    """
+    report = ParseReport(limit=2)
+    appts = list(Agenda.iter_file(io.StringIO(agtxt), report))
+    assert [ appt.desc for appt in appts ] == [ "standup", "review", "retro" ]
+    assert len(report) == 3
+    assert [ lineno for lineno, reason in report ] == [ 4, 5 ]
+
+    listed = Agenda.from_file(io.StringIO(agtxt), ParseReport())
+    streamed = Agenda()
+    for appt in normalize_stream(Agenda.iter_file(io.StringIO(agtxt))):
+        streamed.append(appt)
+    listed.normalize()
+    assert streamed == listed
+    assert str(streamed) == str(listed)
+
+    day = Appt.from_string("12-01-2013 8:00 AM to 12-01-2013 6:00 PM| free")
+    free = Agenda()
+    for appt in complement_stream(Agenda.iter_file(io.StringIO(agtxt)), day):
+        free.append(appt)
+    assert free == listed.complement(day)
+
+    try:
+        list(normalize_stream(reversed(appts)))
+        assert False, "stream out of order"
+    except ValueError:
+        pass
+
+def selftest_sorted_agenda():
+    """SortedAgenda's cached normalization against a full normalize."""
+    import random
+    rand = random.Random(7)
+    base = arrow.get("2016-03-01T08:00:00")
+    day = Appt(base.replace(hours=+1), base.replace(hours=+9), "Free")
+
+    for trial in range(10):
+        growing = SortedAgenda()
+        plain = Agenda()
+        for i in range(60):
+            begin = base.replace(minutes=+15 * rand.randint(0, 40))
+            end = begin.replace(minutes=+15 * rand.randint(1, 6))
+            appt = Appt(begin, end, "appt" + str(i))
+            growing.append(appt)
+            plain.append(appt)
+
+            expected = Agenda()
+            expected.appts = list(plain.appts)
+            assert str(growing.complement(day)) == str(expected.complement(day))
+            assert growing.complement(day) == expected.complement(day)
+            expected.normalize()
+            assert str(growing.normalized()) == str(expected)
+            assert growing.normalized() == expected
+
+def selftest_epoch_pairs():
+    """Agendas survive a round trip through stored epoch pairs."""
+    ag = Agenda.from_dict([
+        {"start": "03/01/2016 9:00 AM", "end": "03/01/2016 10:30 AM", "desc": "Free"},
+        {"start": "03/02/2016 1:00 PM", "end": "03/02/2016 3:15 PM", "desc": "Free"}])
+    pairs = ag.epoch_pairs()
+    assert pairs == [ [1456822800, 1456828200], [1456923600, 1456931700] ]
+    assert Agenda.from_epoch_pairs(pairs, "Free") == ag
+    assert ArrayAgenda.from_epoch_pairs(pairs, "Free").epoch_pairs() == pairs
+    assert Agenda.from_epoch_pairs([]).epoch_pairs() == []
+
+def selftest_difference():
+    """Taking busy times out of a free list, against a full recompute."""
+    import random
+    rand = random.Random(16)
+    base = arrow.get("2016-03-01T08:00:00")
+    day = Appt(base, base.replace(hours=+10), "Free")
+
+    for trial in range(30):
+        old = random_agenda(rand, rand.randint(0, 20), base, -8, 44, 8, "busy")
+        new = random_agenda(rand, rand.randint(0, 20), base, -8, 44, 8, "busy")
+        free = old.complement(day)
+        everyone = Agenda()
+        everyone.appts = old.appts + new.appts
+        expected = everyone.complement(day)
+        assert str(free.difference(new)) == str(expected)
+        assert free.difference(new) == expected
+        assert ArrayAgenda.from_agenda(free).difference(new) == expected
+
+def selftest_find_slots():
+    """The top k slots against ranking every candidate."""
+    import random
+    import datetime
+    from dateutil import tz
+    rand = random.Random(24)
+    base = arrow.get("2016-03-01T08:00:00")
+    day = Appt(base, base.replace(days=+3), "Free")
+    pacific = tz.gettz("US/Pacific")
+
+    for trial in range(20):
+        busy = random_agenda(rand, rand.randint(0, 30), base, 0, 4 * 72, 12, "busy")
+        free = busy.complement(day)
+        duration = 15 * 60 * rand.randint(1, 8)
+        k = rand.randint(1, 10)
+        prefs = rand.choice([ None, { "part": "morning" },
+                              { "part": "afternoon", "tzinfo": pacific },
+                              { "buffer": 30 * 60, "step": 30 * 60 },
+                              { "buffer": 45 * 60,
+                                "open_edges": { day.begin.timestamp, day.end.timestamp } } ])
+        wanted = prefs or { }
+        step = wanted.get("step", 15 * 60)
+
+        candidates = [ ]
+        for appt in free:
+            begin, end = appt.begin.timestamp, appt.end.timestamp
+            start = begin
+            while start + duration <= end:
+                local = arrow.get(start).to(wanted.get("tzinfo", "UTC"))
+                wrong = 0
+                if "part" in wanted:
+                    wrong = 0 if (local.hour < 12) == (wanted["part"] == "morning") else 1
+                edges = wanted.get("open_edges", ())
+                before = float("inf") if begin in edges else start - begin
+                after = float("inf") if end in edges else end - start - duration
+                short = max(0, wanted.get("buffer", 0) - min(before, after))
+                candidates.append((wrong, short, start))
+                start += step
+        expected = [ start for wrong, short, start in sorted(candidates)[:k] ]
+
+        slots = free.find_slots(duration, k, prefs)
+        assert [ appt.begin.timestamp for appt in slots ] == expected
+        assert all(appt.end.timestamp - appt.begin.timestamp == duration
+                   for appt in slots)
+        arrayed = ArrayAgenda.from_agenda(free).find_slots(duration, k, prefs)
+        assert arrayed.epoch_pairs() == slots.epoch_pairs()
+
+
+def selftest_attendance():
+    """Counts and best slots against counting quarter hour by quarter hour."""
+    import random
+    import datetime
+    rand = random.Random(25)
+    dates = (datetime.date(2016, 3, 1), datetime.date(2016, 3, 3))
+    nine, five = datetime.time(9, 0), datetime.time(17, 0)
+    base = arrow.get("2016-03-01T00:00:00")
+    quarter = 15 * 60
+
+    for trial in range(20):
+        people = [ ]
+        for person in range(rand.randint(1, 12)):
+            busy = random_agenda(rand, rand.randint(0, 15), base, 0, 4 * 72, 16, "busy")
+            people.append(busy if rand.random() < 0.5 else ArrayAgenda.from_agenda(busy))
+        coverage = Agenda.attendance(people, dates, nine, five)
+
+        #free count for each quarter hour in the windows
+        expected = { }
+        for day in range(3):
+            opening = base.timestamp + day * 24 * 3600 + 9 * 3600
+            for start in range(opening, opening + 8 * 3600, quarter):
+                expected[start] = sum(
+                    1 for busy in people
+                    if not any(appt.begin.timestamp < start + quarter and
+                               start < appt.end.timestamp for appt in busy))
+        counted = { }
+        for begin, end, free in coverage:
+            assert begin < end
+            for start in range(begin, end, quarter):
+                counted[start] = free
+        assert counted == expected
+        assert all(before[2] != after[2] for before, after in zip(coverage, coverage[1:])
+                   if before[1] == after[0])
+
+        q = rand.randint(0, len(people))
+        duration = quarter * rand.randint(1, 8)
+        k = rand.randint(1, 5)
+        scores = { }
+        for start in expected:
+            inside = [ expected.get(t) for t in range(start, start + duration, quarter) ]
+            if None not in inside and min(inside) >= q:
+                scores[start] = min(inside)
+        slots = Agenda.best_attended(coverage, q, duration, k)
+        #only slots lined up with a change of count are offered
+        assert len(slots) <= k and bool(slots) == bool(scores)
+        assert len(set(begin for begin, end, free in slots)) == len(slots)
+        for begin, end, free in slots:
+            assert end - begin == duration
+            assert scores[begin] == free
+        assert [ free for begin, end, free in slots ] == \
+               sorted((free for begin, end, free in slots), reverse=True)
+        if scores:
+            best = max(scores.values())
+            assert slots[0] == (min(start for start in scores if scores[start] == best),
+                                min(start for start in scores if scores[start] == best)
+                                + duration, best)
@@ -0,0 +1,374 @@
+"""
+Self tests for main.py, run like those in test_agenda.py.  main.py
+is loaded the way loadtest.py loads it, with mongomock for the db
+(pip install -r requirements-test.txt) and a FakeCalendar in place
+of Google.
+"""
+import random
+import datetime
+import arrow
+from dateutil import tz
+import loadtest
+
+PACIFIC = tz.gettz("US/Pacific")
+
+## One calendar of events given in the calendar's own zone, as the
+## events API gives them; FakeCalendar gives freebusy in UTC
+RECORDED = { "tester-0": [
+    { "summary": "standup",
+      "start": { "dateTime": "2016-03-01T10:00:00-08:00" },
+      "end": { "dateTime": "2016-03-01T11:00:00-08:00" } },
+    { "summary": "call east",
+      "start": { "dateTime": "2016-03-02T16:00:00-05:00" },
+      "end": { "dateTime": "2016-03-02T17:30:00-05:00" } },
+    { "summary": "late",
+      "start": { "dateTime": "2016-03-03T16:30:00-08:00" },
+      "end": { "dateTime": "2016-03-03T18:00:00-08:00" } },
+    { "summary": "evening",
+      "start": { "dateTime": "2016-03-03T19:00:00-08:00" },
+      "end": { "dateTime": "2016-03-03T20:00:00-08:00" } } ] }
+
+fake = loadtest.FakeCalendar(latency=0, recorded=RECORDED)
+main = loadtest.load_app(fake, "memory")
+
+
+def credentials(user="tester"):
+    return main.client.OAuth2Credentials.from_json(loadtest.credentials_for(user))
+
+
+def pacific_window():
+    """9 to 5 in US/Pacific, 03/01/2016 to 03/04/2016."""
+    return main.EventWindow("2016-03-01T00:00:00-08:00", "2016-03-04T00:00:00-08:00",
+                            "2016-03-01T09:00:00-08:00", "2016-03-01T17:00:00-08:00",
+                            PACIFIC)
+
+
+def selftest_freebusy_matches_events():
+    """The same events give the same busy times from either source,
+    though freebusy gives them in UTC and the window is in Pacific time.
+    """
+    window = pacific_window()
+    listed, failed = main.busy_from_events(credentials(), [ "tester-0" ], window)
+    assert failed == [ ]
+    periods, failed = main.busy_from_freebusy(credentials(), [ "tester-0" ], window)
+    assert failed == [ ]
+    #10-11am, 1-2:30pm and 4:30-6pm Pacific (only the evening is outside)
+    expected = [ [1456855200, 1456858800], [1456952400, 1456957800],
+                 [1457051400, 1457056800] ]
+    assert listed.normalized().epoch_pairs() == expected
+    assert periods.normalized().epoch_pairs() == expected
+
+
+def selftest_cache_window():
+    """The cache keeps no events that are over, and only events in
+    the window come back from it.
+    """
+    day = arrow.utcnow().floor('day').replace(days=+10)
+    def event(id, begin, hours):
+        return { "id": id, "summary": id,
+                 "start": { "dateTime": begin.isoformat() },
+                 "end": { "dateTime": begin.replace(hours=+hours).isoformat() } }
+    fake.recorded["cacher-0"] = [
+        event("past", arrow.get("2016-03-01T10:00:00+00:00"), 1),
+        event("inside", day.replace(hours=+10), 1),
+        event("later", day.replace(days=+30, hours=+10), 1) ]
+    window = main.EventWindow(day.isoformat(), day.replace(days=+2).isoformat(),
+                              day.replace(hours=+9).isoformat(),
+                              day.replace(hours=+17).isoformat(), tz.tzutc())
+    for visit in range(2):
+        busy, failed = main.busy_from_cache(credentials("cacher"), [ "cacher-0" ],
+                                            window, "cacher")
+        assert failed == [ ]
+        assert busy.epoch_pairs() == [ [ day.replace(hours=+10).timestamp,
+                                         day.replace(hours=+11).timestamp ] ]
+    cached = main.event_cache.find_one({ "user": "cacher", "calendar": "cacher-0" })
+    assert sorted(cached['busy']) == [ "inside", "later" ]
+
+
+def selftest_meeting_pages():
+    """Bad page ids give the first page, and the page cache stays bounded."""
+    from bson.objectid import ObjectId
+    client = main.app.test_client()
+    assert client.get("/index?after=notanid").status_code == 200
+    for i in range(main.MEETING_PAGES_MAX + 20):
+        main.list_meetings(str(ObjectId()))
+    main.list_meetings("notanid")
+    assert len(main.meeting_pages) <= main.MEETING_PAGES_MAX
+    assert "notanid" not in main.meeting_pages
+
+
+def selftest_migrate_meetings():
+    """A meeting stored in the old format is upgraded and can be
+    viewed, ranked and answered.
+    """
+    window = pacific_window()
+    old = { "type": "meeting", "attend": [ "ann" ], "title": "old", "place": "here",
+            "start_date": "2016-03-01T00:00:00-08:00",
+            "end_date": "2016-03-01T00:00:00-08:00",
+            "start_time": "2016-03-01T09:00:00-08:00",
+            "end_time": "2016-03-01T17:00:00-08:00",
+            "free": [ { "start": "2016-03-01T09:00:00-08:00",
+                        "end": "2016-03-01T12:00:00-08:00", "desc": "Free" },
+                      { "start": "2016-03-01T15:00:00-08:00",
+                        "end": "2016-03-01T17:00:00-08:00", "desc": "Free" } ],
+            "busy": [ { "start": "03/01/2016 12:00 PM", "end": "03/01/2016 1:00 PM",
+                        "desc": "lunch" } ] }
+    id = main.collection.insert_one(old).inserted_id
+    assert main.migrate_meetings() == 1
+    assert main.migrate_meetings() == 0
+    meeting = main.collection.find_one({ "_id": id })
+    assert "busy" not in meeting
+    assert meeting['free'] == [ [1456851600, 1456862400], [1456873200, 1456880400] ]
+
+    client = main.app.test_client()
+    assert b"(bad time)" not in client.get("/meeting/" + str(id)).data
+    slots = client.get("/slots/" + str(id) + "?duration=60&k=2").get_json()['slots']
+    assert slots == [ [1456851600, 1456855200], [1456852500, 1456856100] ]
+
+    #an invitee busy 10-11am Pacific (the standup) answering the old meeting
+    job = { "credentials": loadtest.credentials_for("tester"), "cals": [ "tester-0" ],
+            "source": "events", "user": None, "invitee": True, "name": "bob",
+            "answer": "bob", "id": str(id), "window": main.EventWindow(
+                old['start_date'], old['end_date'], old['start_time'],
+                old['end_time'], PACIFIC) }
+    assert main.run_conflicts(job) == [ ]
+    meeting = main.collection.find_one({ "_id": id })
+    assert meeting['free'] == [ [1456851600, 1456855200], [1456858800, 1456862400],
+                                [1456873200, 1456880400] ]
+    assert sorted(meeting['attend']) == [ "ann", "bob" ]
+
+
+def selftest_empty_name():
+    """An invitee without a name can't take the organizer's place."""
+    client = main.app.test_client()
+    with client.session_transaction() as session:
+        session['id'] = "0" * 24
+    response = client.post("/invitee_name", data={ "name": "  " })
+    assert response.status_code == 302
+    assert response.location.endswith("/invitee/" + "0" * 24)
+    with client.session_transaction() as session:
+        assert 'name' not in session
+
+
+def selftest_backwards_window():
+    """A daily window ending before it starts is turned away before
+    any meeting can be made with it.
+    """
+    client = main.app.test_client()
+    form = { "daterange": "03/01/2016 - 03/04/2016", "about": "late",
+             "place": "here", "start": "5:00pm", "end": "9:00am" }
+    response = client.post("/setrange", data=form)
+    assert response.status_code == 302
+    assert response.location.endswith("/create")
+    with client.session_transaction() as session:
+        assert 'start_time' not in session and 'title' not in session
+        assert "must be after" in session['_flashes'][-1][1]
+    form['end'] = "5:00pm"
+    assert client.post("/setrange", data=form).location.endswith("/create")
+    form['start'] = "9:00am"
+    assert client.post("/setrange", data=form).location.endswith("/choose")
+    with client.session_transaction() as session:
+        assert session['title'] == "late"
+
+def selftest_concurrent_answers():
+    """Two invitees answering at once both end up taken out of the free times."""
+    window = pacific_window()
+    def job(user, **more):
+        found = { "credentials": loadtest.credentials_for(user),
+                  "cals": [ user + "-0" ], "source": "events", "user": None,
+                  "window": window }
+        found.update(more)
+        return found
+    def hour(day, at):
+        begin = arrow.Arrow(2016, 3, day, at, tzinfo=PACIFIC)
+        return { "start": { "dateTime": begin.isoformat() },
+                 "end": { "dateTime": begin.replace(hours=+1).isoformat() } }
+    fake.recorded["org-0"] = [ ]
+    fake.recorded["ann-0"] = [ hour(1, 10) ]
+    fake.recorded["cat-0"] = [ hour(2, 14) ]
+    main.run_conflicts(job("org", invitee=False, meeting={
+        "type": "meeting", "attend": [ ], "title": "race", "place": "here",
+        "start_date": window.time_min, "end_date": "2016-03-04T00:00:00-08:00",
+        "start_time": "2016-03-01T09:00:00-08:00", "end_time": "2016-03-01T17:00:00-08:00" }))
+    id = main.collection.find_one({ "title": "race" })['_id']
+
+    #cat answers completely while ann is between reading and writing
+    class Interleaved:
+        def __init__(self, collection):
+            self.collection = collection
+            self.pending = True
+        def __getattr__(self, name):
+            return getattr(self.collection, name)
+        def update_one(self, *args, **kwargs):
+            if self.pending:
+                self.pending = False
+                main.run_conflicts(job("cat", invitee=True, name="cat", answer="cat", id=str(id)))
+            return self.collection.update_one(*args, **kwargs)
+    original = main.collection
+    main.collection = Interleaved(original)
+    try:
+        main.run_conflicts(job("ann", invitee=True, name="ann", answer="ann", id=str(id)))
+    finally:
+        main.collection = original
+
+    meeting = main.collection.find_one({ "_id": id })
+    assert sorted(meeting['attend']) == [ "ann", "cat" ]
+    expected = main.find_free(main.meeting_busy(id), window).epoch_pairs()
+    assert meeting['free'] == expected
+    busy = [ [1456855200, 1456858800], [1456956000, 1456959600] ]
+    assert not any(begin < end_busy and begin_busy < end
+                   for begin, end in meeting['free'] for begin_busy, end_busy in busy)
+
+
+def selftest_same_name():
+    """Two invitees giving the same name each keep their own busy
+    times; answering again only replaces your own.
+    """
+    def answer(client):
+        client.post("/invitee_name", data={ "name": "Sam" })
+        with client.session_transaction() as session:
+            return session['answer']
+    first, second = main.app.test_client(), main.app.test_client()
+    for client in [ first, second ]:
+        with client.session_transaction() as session:
+            session['id'] = "1" * 24
+    answers = [ answer(first), answer(second) ]
+    assert answers[0] != answers[1]
+    assert answer(first) == answers[0]
+
+    window = pacific_window()
+    def job(user, **more):
+        found = { "credentials": loadtest.credentials_for(user),
+                  "cals": [ user + "-0" ], "source": "events", "user": None,
+                  "window": window }
+        found.update(more)
+        return found
+    def hour(day, at):
+        begin = arrow.Arrow(2016, 3, day, at, tzinfo=PACIFIC)
+        return { "start": { "dateTime": begin.isoformat() },
+                 "end": { "dateTime": begin.replace(hours=+1).isoformat() } }
+    fake.recorded["org-0"] = [ ]
+    fake.recorded["ann-0"] = [ hour(1, 10) ]
+    fake.recorded["cat-0"] = [ hour(2, 14) ]
+    main.run_conflicts(job("org", invitee=False, meeting={
+        "type": "meeting", "attend": [ ], "title": "twins", "place": "here",
+        "start_date": window.time_min, "end_date": "2016-03-04T00:00:00-08:00",
+        "start_time": "2016-03-01T09:00:00-08:00", "end_time": "2016-03-01T17:00:00-08:00" }))
+    id = main.collection.find_one({ "title": "twins" })['_id']
+    main.run_conflicts(job("ann", invitee=True, name="Sam", answer=answers[0], id=str(id)))
+    main.run_conflicts(job("cat", invitee=True, name="Sam", answer=answers[1], id=str(id)))
+    meeting = main.collection.find_one({ "_id": id })
+    assert meeting['attend'] == [ "Sam", "Sam" ]
+    assert len(main.meeting_busy(id)) == 3
+    def overlaps(busy):
+        return any(begin < busy[1] and busy[0] < end
+                   for begin, end in main.collection.find_one({ "_id": id })['free'])
+    assert not overlaps([1456855200, 1456858800])
+    assert not overlaps([1456956000, 1456959600])
+
+    #the first Sam answers again with a clear calendar
+    main.run_conflicts(job("org", invitee=True, name="Sam", answer=answers[0], id=str(id)))
+    meeting = main.collection.find_one({ "_id": id })
+    assert meeting['attend'] == [ "Sam", "Sam" ]
+    assert len(main.meeting_busy(id)) == 3
+    assert overlaps([1456855200, 1456858800])
+    assert not overlaps([1456956000, 1456959600])
+
+
+def selftest_event_time():
+    """Google times read into the window's zone, whatever their offset."""
+    standup = (datetime.date(2016, 3, 1).toordinal(), 10 * 3600, 1456855200)
+    for text in [ "2016-03-01T10:00:00-08:00", "2016-03-01T18:00:00Z",
+                  "2016-03-01T18:00:00.000Z", "2016-03-01T13:00:00-05:00",
+                  "2016-03-01T23:30:00+05:30" ]:
+        assert main.event_time(text, PACIFIC) == standup
+        assert main.event_time(text, PACIFIC, end=True) == standup
+    #late evening in Pacific time is the next day in UTC
+    assert main.event_time("2016-03-02T05:00:00Z", PACIFIC) == \
+        (datetime.date(2016, 3, 1).toordinal(), 21 * 3600, 1456894800)
+    assert main.event_time("2016-03-02T05:00:00Z", tz.tzutc()) == \
+        (datetime.date(2016, 3, 2).toordinal(), 5 * 3600, 1456894800)
+    #all-day events: from midnight in the window's zone, to the end
+    #of the day before the date Google gives as the end
+    assert main.event_time("2016-03-01", PACIFIC) == \
+        (datetime.date(2016, 3, 1).toordinal(), 0, 1456819200)
+    assert main.event_time("2016-03-02", PACIFIC, end=True) == \
+        (datetime.date(2016, 3, 1).toordinal(), 24 * 3600, 1456905600)
+
+
+def is_conflict(window, start, end):
+    """The check main.py made before EventWindow, one event at a
+    time with arrow, on times taken into the window's zone.
+    """
+    start = arrow.get(start).to(window.tzinfo)
+    end = arrow.get(end).to(window.tzinfo)
+    first, last = window.dates
+    day_start, day_end = window.times
+    if not (first <= start.date() <= last) or not (first <= end.date() <= last):
+        return False
+    elif end.time() <= day_start:
+        return False
+    elif start.time() >= day_end:
+        return False
+    else:
+        return True
+
+
+def selftest_window_conflicts():
+    """EventWindow.conflicts against is_conflict on random events
+    with every kind of offset.
+    """
+    rand = random.Random(18)
+    offsets = [ "Z", "-08:00", "-05:00", "+05:30", "+00:00" ]
+    base = arrow.get("2016-02-29T00:00:00+00:00")
+    for window in [ pacific_window(),
+                    main.EventWindow("2016-03-02", "2016-03-03", "2016-03-02T08:30:00",
+                                     "2016-03-02T12:15:00", tz.tzutc()) ]:
+        spans = [ ]
+        for i in range(5000):
+            begin = base.replace(minutes=+15 * rand.randint(0, 4 * 24 * 7))
+            end = begin.replace(minutes=+15 * rand.randint(1, 4 * 30))
+            texts = [ ]
+            for when in (begin, end):
+                offset = rand.choice(offsets)
+                local = when.to("UTC" if offset == "Z" else offset)
+                texts.append(local.format("YYYY-MM-DDTHH:mm:ss") +
+                             rand.choice([ "", ".000" ]) + offset)
+            spans.append(tuple(texts))
+        found = window.conflicts(spans)
+        expected = [ (arrow.get(start).timestamp, arrow.get(end).timestamp)
+                     if is_conflict(window, start, end) else None
+                     for start, end in spans ]
+        assert found == expected
+        assert any(found) and None in found
+
+
+def selftest_slot_buffer():
+    """The buffer is wanted from busy times, not from the opening
+    and closing of each day's window.
+    """
+    window = main.EventWindow("2016-03-01T00:00:00", "2016-03-02T00:00:00",
+                              "2016-03-01T09:00:00", "2016-03-01T17:00:00")
+    opening = arrow.Arrow(2016, 3, 1, 9, tzinfo=window.tzinfo).timestamp
+    fake.recorded["buffer-0"] = [ {
+        "start": { "dateTime": arrow.get(opening).replace(hours=+4).isoformat() },
+        "end": { "dateTime": arrow.get(opening).replace(hours=+5).isoformat() } } ]
+    main.run_conflicts({ "credentials": loadtest.credentials_for("buffer"),
+                         "cals": [ "buffer-0" ], "source": "events", "user": None,
+                         "window": window, "invitee": False, "meeting": {
+                             "type": "meeting", "attend": [ ], "title": "buffer",
+                             "place": "here", "start_date": "2016-03-01T00:00:00",
+                             "end_date": "2016-03-02T00:00:00",
+                             "start_time": "2016-03-01T09:00:00",
+                             "end_time": "2016-03-01T17:00:00" } })
+    id = str(main.collection.find_one({ "title": "buffer" })['_id'])
+    client = main.app.test_client()
+    slots = client.get("/slots/" + id + "?duration=60&k=3&buffer=30").get_json()['slots']
+    #9am needs no buffer before it
+    assert [ begin for begin, end in slots ] == \
+        [ opening, opening + 900, opening + 1800 ]
+    #9 to 1 the first day runs right up to the busy time; the whole
+    #of the second day is free
+    slots = client.get("/slots/" + id + "?duration=240&k=2&buffer=30").get_json()['slots']
+    assert slots == [ [ opening + 24 * 3600, opening + 28 * 3600 ],
+                      [ opening + 24 * 3600 + 900, opening + 28 * 3600 + 900 ] ]
@@ -0,0 +1,107 @@
+"""
+Self tests for session_store.py, run like those in test_agenda.py:
+requests through the Flask test client against a MemoryStore, with
+the session cookie handled by hand so each test sees exactly what
+the browser would.
+"""
+import flask
+from session_store import StoredSessionInterface, MemoryStore
+
+
+def make_app():
+    """A small app to read and change the session through."""
+    app = flask.Flask(__name__)
+    app.secret_key = "test"
+    store = MemoryStore()
+    app.session_interface = StoredSessionInterface(store)
+
+    @app.route("/set/<key>/<value>")
+    def set_value(key, value):
+        flask.session[key] = value
+        return ""
+
+    @app.route("/get/<key>")
+    def get_value(key):
+        return flask.session.get(key, "(none)")
+
+    @app.route("/delete/<key>")
+    def delete_value(key):
+        del flask.session[key]
+        return ""
+
+    @app.route("/big/<key>")
+    def set_big(key):
+        flask.session[key] = [ "x" * 100 ] * 100
+        return ""
+
+    return app, store
+
+
+def request(client, url, sid=None):
+    """GET url with sid (if any) as the session cookie; returns the
+    response and the sid it sets, or None if it sets no cookie.
+    """
+    headers = { "Cookie": "session=" + sid } if sid else { }
+    response = client.get(url, headers=headers)
+    cookies = [ header for header in response.headers.getlist("Set-Cookie")
+                if header.startswith("session=") ]
+    new_sid = cookies[0].split(";")[0][len("session="):] if cookies else None
+    return response, new_sid
+
+
+def selftest_set_then_get():
+    """A value set in one request is there in the next; the cookie
+    is only set the first time.
+    """
+    app, store = make_app()
+    client = app.test_client(use_cookies=False)
+    response, sid = request(client, "/set/color/blue")
+    assert sid is not None and store.exists(sid)
+    response, again = request(client, "/get/color", sid)
+    assert response.get_data(as_text=True) == "blue"
+    assert again is None
+    response, again = request(client, "/set/shape/round", sid)
+    assert again is None
+    assert request(client, "/get/color", sid)[0].get_data(as_text=True) == "blue"
+    assert request(client, "/get/shape", sid)[0].get_data(as_text=True) == "round"
+    assert request(client, "/get/color")[0].get_data(as_text=True) == "(none)"
+
+
+def selftest_delete():
+    """A deleted key is gone in later requests; the others stay."""
+    app, store = make_app()
+    client = app.test_client(use_cookies=False)
+    sid = request(client, "/set/color/blue")[1]
+    request(client, "/set/shape/round", sid)
+    request(client, "/delete/color", sid)
+    assert request(client, "/get/color", sid)[0].get_data(as_text=True) == "(none)"
+    assert request(client, "/get/shape", sid)[0].get_data(as_text=True) == "round"
+    assert sorted(store.keys(sid)) == [ "shape" ]
+
+
+def selftest_unknown_id():
+    """An id the store never gave out isn't adopted: setting a value
+    under it moves the session to a new id.
+    """
+    app, store = make_app()
+    client = app.test_client(use_cookies=False)
+    forged = "f" * 32
+    #just reading keeps the id but finds nothing and stores nothing
+    response, sid = request(client, "/get/color", forged)
+    assert response.get_data(as_text=True) == "(none)" and sid is None
+    response, sid = request(client, "/set/color/blue", forged)
+    assert sid is not None and sid != forged
+    assert not store.exists(forged)
+    assert request(client, "/get/color", sid)[0].get_data(as_text=True) == "blue"
+
+
+def selftest_cookie_size():
+    """Whatever goes in the session, the cookie is just the id."""
+    app, store = make_app()
+    client = app.test_client(use_cookies=False)
+    response, sid = request(client, "/big/first")
+    assert len(sid) == 32
+    for key in [ "second", "third" ]:
+        response, again = request(client, "/big/" + key, sid)
+        assert again is None
+    assert len(store.load(sid, "third")) == 100